@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""Batched affine data augmentation (rotation, scale, shift) of images and masks with numpy.
+
+Usage: python augmentation.py [--samples 256] to benchmark it against skimage rotations.
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+
+def random_affine_parameters(n_samples, rng, max_angle=8, scale_range=(1.0, 1.0), max_shift=0):
+    '''Draw one random affine transform per sample.
+    Parameters
+    ----------
+    n_samples: int
+        number of transforms
+    rng: np.random.Generator
+        random generator
+    max_angle: float
+        largest rotation in degrees, in either direction
+    scale_range: tuple
+        smallest and largest zoom factor
+    max_shift: float
+        largest translation in pixels, along each axis
+
+    Returns dict of arrays of shape (n_samples,): angle (degrees), scale, shift_y and shift_x
+    '''
+    return {
+        "angle": rng.uniform(-max_angle, max_angle, n_samples),
+        "scale": rng.uniform(scale_range[0], scale_range[1], n_samples),
+        "shift_y": rng.uniform(-max_shift, max_shift, n_samples),
+        "shift_x": rng.uniform(-max_shift, max_shift, n_samples),
+    }
+
+
+def affine_coordinates(parameters, height, width):
+    '''Build the sampling coordinates of a batch of affine transforms about the image center.
+    Positive angles rotate counter-clockwise, like skimage.transform.rotate.
+
+    Returns float32 array of shape (2, N, height, width): row and column to read in each input image
+    for every output pixel
+    '''
+    angle = np.deg2rad(parameters["angle"])[:, None, None]
+    scale = parameters["scale"][:, None, None]
+    center_y, center_x = (height - 1) / 2, (width - 1) / 2
+    rows = np.arange(height)[None, :, None] - center_y - parameters["shift_y"][:, None, None]
+    columns = np.arange(width)[None, None, :] - center_x - parameters["shift_x"][:, None, None]
+
+    cos_angle, sin_angle = np.cos(angle) / scale, np.sin(angle) / scale
+    coordinates = np.empty((2, len(angle), height, width), dtype=np.float32)
+    coordinates[0] = cos_angle * rows + sin_angle * columns + center_y
+    coordinates[1] = cos_angle * columns - sin_angle * rows + center_x
+    return coordinates
+
+
+def warp_batch(batch, coordinates, order=1):
+    '''Resample every image of a (N, H, W) batch at its coordinates in one vectorized gather.
+    Parameters
+    ----------
+    batch: np.ndarray
+        images of shape (N, H, W)
+    coordinates: np.ndarray
+        array of shape (2, N, H', W') returned by affine_coordinates
+    order: int
+        0 for nearest neighbour, 1 for bilinear interpolation
+
+    Returns float32 array of shape (N, H', W'), black where the coordinates fall outside the images
+    '''
+    n_images, height, width = batch.shape
+    stride = width + 2
+    # a black border of one pixel around each image gives the constant fill, and keeps the
+    # interpolation from mixing neighbouring images of the flattened batch
+    padded = np.zeros((n_images, height + 2, stride), dtype=np.float32)
+    padded[:, 1:-1, 1:-1] = batch
+    padded = padded.ravel()
+    rows = np.clip(coordinates[0], -1, height, dtype=np.float32)
+    columns = np.clip(coordinates[1], -1, width, dtype=np.float32)
+    rows += 1
+    columns += 1
+    offsets = (np.arange(n_images, dtype=np.intp) * (height + 2) * stride)[:, None, None]
+
+    if order == 0:
+        index = np.rint(rows).astype(np.intp)
+        index *= stride
+        index += np.rint(columns).astype(np.intp)
+        index += offsets
+        return padded[index]
+
+    # the four neighbours are gathered with the same index from shifted views of the batch
+    top = np.minimum(rows.astype(np.intp), height)
+    left = np.minimum(columns.astype(np.intp), width)
+    rows -= top
+    columns -= left
+    index = top
+    index *= stride
+    index += left
+    index += offsets
+    upper = padded[index]
+    upper += columns * (padded[1:][index] - upper)
+    lower = padded[stride:][index]
+    lower += columns * (padded[stride + 1:][index] - lower)
+    lower -= upper
+    lower *= rows
+    upper += lower
+    return upper
+
+
+def _augment_chunk(x_batch, y_batch, seed, mask_order, max_angle, scale_range, max_shift):
+    '''Augment one chunk of a batch.'''
+    rng = np.random.default_rng(seed)
+    parameters = random_affine_parameters(len(x_batch), rng, max_angle, scale_range, max_shift)
+    coordinates = affine_coordinates(parameters, x_batch.shape[1], x_batch.shape[2])
+    return warp_batch(x_batch, coordinates, 1), warp_batch(y_batch, coordinates, mask_order)
+
+
+def augment_batch(x_batch, y_batch, max_angle=8, scale_range=(1.0, 1.0), max_shift=0, mask_order=0, seed=None,
+                  chunk_size=16):
+    '''Apply a random rotation, zoom and shift to every image of a batch and the same transform to its mask.
+    The coordinate maps are built once per chunk of samples, and images and masks are each warped with
+    one vectorized interpolation per chunk. Chunks are kept small enough to stay in the CPU cache.
+    Parameters
+    ----------
+    x_batch, y_batch: np.ndarray
+        images and masks of shape (N, H, W) or (N, H, W, 1)
+    max_angle, scale_range, max_shift:
+        ranges of the random transforms (see random_affine_parameters)
+    mask_order: int
+        interpolation of the masks: 0 (nearest) keeps binary masks binary, 1 (linear) smooths their border
+    seed: int
+        seed making the augmentation reproducible
+    chunk_size: int
+        number of samples warped at once
+
+    Returns (x_augmented, y_augmented), float arrays with the shapes of x_batch and y_batch
+    '''
+    x_shape, y_shape = np.shape(x_batch), np.shape(y_batch)
+    x_batch = np.reshape(x_batch, x_shape[:3]).astype(np.float32, copy=False)
+    y_batch = np.reshape(y_batch, y_shape[:3]).astype(np.float32, copy=False)
+    chunk_starts = range(0, len(x_batch), chunk_size)
+    seeds = np.random.SeedSequence(seed).spawn(len(chunk_starts))
+    x_augmented = np.empty(x_batch.shape, dtype=np.float32)
+    y_augmented = np.empty(y_batch.shape, dtype=np.float32)
+    for start, chunk_seed in zip(chunk_starts, seeds):
+        chunk = slice(start, start + chunk_size)
+        x_augmented[chunk], y_augmented[chunk] = _augment_chunk(x_batch[chunk], y_batch[chunk], chunk_seed, mask_order,
+                                                                max_angle, scale_range, max_shift)
+    return np.reshape(x_augmented, x_shape), np.reshape(y_augmented, y_shape)
+
+
+def augmented_copies(x_batch, y_batch, copies=1, flip_probability=0.5, transform_probability=1.0, seed=None, **transform):
+    '''Return a batch followed by copies of it, each sample randomly flipped left-right and transformed by augment_batch.
+    Used when augmentations have to be computed ahead of training (see feature_cache).
+    Parameters
+    ----------
+    x_batch, y_batch: np.ndarray
+        images and masks of shape (N, H, W) or (N, H, W, 1)
+    copies: int
+        number of augmented copies of the batch
+    flip_probability: float
+        probability of flipping a sample of a copy
+    transform_probability: float
+        probability of transforming a sample of a copy, the others keeping their original orientation
+    seed: int
+        seed making the copies reproducible
+    transform:
+        keyword arguments of augment_batch (max_angle, scale_range, max_shift, mask_order, chunk_size)
+
+    Returns (x, y), arrays of (copies + 1) * N samples keeping the dtypes of x_batch and y_batch, so that
+    uint8 datasets stay uint8 (augmented values are then rounded)
+    '''
+    x_batch, y_batch = np.asarray(x_batch), np.asarray(y_batch)
+    seeds = np.random.SeedSequence(seed).spawn(copies)
+    x_all, y_all = [x_batch], [y_batch]
+    for copy_seed in seeds:
+        rng = np.random.default_rng(copy_seed)
+        flipped = rng.uniform(size=len(x_batch)) < flip_probability
+        transformed = rng.uniform(size=len(x_batch)) < transform_probability
+        x_copy, y_copy = x_batch.copy(), y_batch.copy()
+        x_copy[flipped] = x_copy[flipped, :, ::-1]
+        y_copy[flipped] = y_copy[flipped, :, ::-1]
+        x_transformed, y_transformed = augment_batch(x_copy[transformed], y_copy[transformed],
+                                                     seed=int(copy_seed.generate_state(1)[0]), **transform)
+        x_copy[transformed] = _as_dtype(x_transformed, x_batch.dtype)
+        y_copy[transformed] = _as_dtype(y_transformed, y_batch.dtype)
+        x_all.append(x_copy)
+        y_all.append(y_copy)
+    return np.concatenate(x_all), np.concatenate(y_all)
+
+
+def _as_dtype(array, dtype):
+    '''Convert warped values back to the dtype of a dataset, rounding and clipping them for integer dtypes.'''
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        array = np.clip(np.rint(array), info.min, info.max)
+    return array.astype(dtype, copy=False)
+
+
+def _skimage_random_rotation(x, y):
+    '''Former transfer_learning.random_rotation, kept as the benchmark reference.'''
+    from skimage import transform
+
+    angle = np.random.randint(8) * (1 if np.random.randint(2) else -1)
+    x_rotated = transform.resize(transform.rotate(x, angle), (160, 160))
+    y_rotated = transform.resize(transform.rotate(y, angle), (160, 160))
+    return (np.reshape(x_rotated, (160, 160, 1)), np.reshape(y_rotated, (160, 160, 1)))
+
+
+def benchmark(n_samples=256, repeats=3):
+    '''Time the per-sample skimage rotation against augment_batch on random 160x160 samples.
+
+    Returns dict of the best time in seconds of each method
+    '''
+    rng = np.random.default_rng(0)
+    x_batch = rng.uniform(0, 255, (n_samples, 160, 160)).astype(np.float32)
+    y_batch = (rng.uniform(0, 1, (n_samples, 160, 160)) > 0.5).astype(np.float32)
+
+    def best_time(function):
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    timings = {"augment_batch": best_time(lambda: augment_batch(x_batch, y_batch, seed=0))}
+    try:
+        timings["skimage_random_rotation"] = best_time(lambda: [_skimage_random_rotation(x, y) for x, y in zip(x_batch, y_batch)])
+    except ImportError:
+        pass
+    return timings
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark batched affine augmentation against skimage rotations.")
+    parser.add_argument("--samples", type=int, default=256, help="number of 160x160 samples")
+    args = parser.parse_args()
+
+    for method, seconds in benchmark(args.samples).items():
+        print(f"{method:>24}: {seconds*1000:8.1f} ms ({args.samples/seconds:.0f} samples/s)")
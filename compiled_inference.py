@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""Keras models wrapped in a traced tf.function for low-latency inference, with latency statistics.
+"""
+
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+from model_registry import get_tf
+
+
+class CompiledModel:
+    '''Keras model called through a tf.function traced once for any batch size.
+
+    The input signature is fixed to (None, *model input shape) float32, so new batch sizes do not
+    trigger retracing. Can be called like the Keras model: model(batch, training=False) returns the
+    predictions as a numpy array. The latency of the last calls is kept for latency_stats().
+    '''
+
+    def __init__(self, model, jit_compile=False, warm_up_batch_size=1, latency_window=1000):
+        '''
+        Parameters
+        ----------
+        model: tf.keras.Model
+            model to wrap
+        jit_compile: bool
+            compile the traced function with XLA
+        warm_up_batch_size: int
+            batch size of the warm-up call tracing the function, 0 to skip the warm-up
+        latency_window: int
+            number of most recent calls kept for the latency statistics
+        '''
+        tf = get_tf()
+        self.model = model
+        self.weights = model.weights
+        self.input_shape = tuple(model.input_shape[1:])
+        signature = [tf.TensorSpec((None,) + self.input_shape, tf.float32)]
+        self._predict = tf.function(lambda batch: model(batch, training=False), input_signature=signature,
+                                    jit_compile=jit_compile)
+        self._latencies = deque(maxlen=latency_window)
+        self._lock = threading.Lock()
+        if warm_up_batch_size:
+            self.warm_up(warm_up_batch_size)
+
+    def warm_up(self, batch_size=1):
+        '''Trace (and compile) the function with a black batch, outside of the latency statistics.'''
+        self._predict(np.zeros((batch_size,) + self.input_shape, dtype=np.float32))
+
+    def __call__(self, batch, training=False):
+        batch = np.reshape(np.asarray(batch, dtype=np.float32), (-1,) + self.input_shape)
+        start = time.perf_counter()
+        predictions = self._predict(batch).numpy()
+        latency = time.perf_counter() - start
+        with self._lock:
+            self._latencies.append(latency)
+        return predictions
+
+    def latency_stats(self):
+        '''Return the latency of the recent calls in milliseconds.
+
+        Returns dict with the number of calls, the mean, the median (p50), the 99th percentile (p99) and the maximum
+        '''
+        with self._lock:
+            latencies = np.array(self._latencies) * 1000
+        if latencies.size == 0:
+            return {"calls": 0, "mean": float("nan"), "p50": float("nan"), "p99": float("nan"), "max": float("nan")}
+        return {"calls": int(latencies.size), "mean": float(latencies.mean()), "p50": float(np.percentile(latencies, 50)),
+                "p99": float(np.percentile(latencies, 99)), "max": float(latencies.max())}
+
+    def reset_latency_stats(self):
+        '''Forget the recorded latencies.'''
+        with self._lock:
+            self._latencies.clear()
@@ -0,0 +1,395 @@
+"""
+Sharded, memory-mapped array store for datasets of equally shaped samples.
+Replaces the one-pickle-per-sample layout with a few .npy shards and an index file.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+
+LISTING_FILE = "listing.json"  # signatures of the source files of a decoded image cache
+DECODING = "grayscale-uint8-reshape"  # preprocessing of _decode_image, part of the decoded cache key
+
+
+class ArrayDatasetStore:
+    """
+    Append-only dataset of fixed-shape arrays, stored as .npy shards read through memory maps.
+
+    Store layout:
+    store_root/
+    ├── index.json          sample shape, dtype, shard capacity, shard list and sample ids
+    ├── shard_00000.npy     (shard_size, *sample_shape) array, filled in order
+    └── shard_00001.npy
+    """
+
+    INDEX_FILE = "index.json"
+    SHARD_PATTERN = "shard_{:05d}.npy"
+    DEFAULT_SHARD_SIZE = 1024
+    WRITABLE_MODES = ('r+', 'w+')
+
+    def __init__(self, root, sample_shape=None, dtype=None, shard_size=DEFAULT_SHARD_SIZE):
+        """
+        Open an existing store, or create an empty one.
+
+        Args:
+            root: Directory of the store
+            sample_shape: Shape of one sample (required to create a store)
+            dtype: Dtype of the samples (required to create a store)
+            shard_size: Number of samples per shard file (creation only)
+
+        Raises:
+            ValueError: If the store does not exist and sample_shape or dtype is missing,
+                or if they do not match an existing store
+        """
+        self.root = Path(root)
+        self._shards = []  # open memmaps, loaded lazily
+        index_path = self.root / self.INDEX_FILE
+
+        if index_path.exists():
+            with open(index_path, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+            self.sample_shape = tuple(index["sample_shape"])
+            self.dtype = np.dtype(index["dtype"])
+            self.shard_size = index["shard_size"]
+            self._ids = index["ids"]
+            if sample_shape is not None and tuple(sample_shape) != self.sample_shape:
+                raise ValueError(f"Store {self.root} holds samples of shape {self.sample_shape}, not {tuple(sample_shape)}")
+            if dtype is not None and np.dtype(dtype) != self.dtype:
+                raise ValueError(f"Store {self.root} holds {self.dtype} samples, not {np.dtype(dtype)}")
+        else:
+            if sample_shape is None or dtype is None:
+                raise ValueError(f"No store at {self.root}: sample_shape and dtype are needed to create one")
+            self.sample_shape = tuple(sample_shape)
+            self.dtype = np.dtype(dtype)
+            self.shard_size = int(shard_size)
+            self._ids = []
+            self.root.mkdir(parents=True, exist_ok=True)
+            self.flush()
+
+        self._positions = {sample_id: position for position, sample_id in enumerate(self._ids)}
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __contains__(self, sample_id) -> bool:
+        return sample_id in self._positions
+
+    def __getitem__(self, sample_id) -> np.ndarray:
+        """Return a view of the sample with this id."""
+        return self.read(self._positions[sample_id])
+
+    @property
+    def ids(self) -> list:
+        """Sample ids, in storage order."""
+        return list(self._ids)
+
+    def position(self, sample_id) -> int:
+        """Return the storage position of a sample id."""
+        return self._positions[sample_id]
+
+    def read(self, position) -> np.ndarray:
+        """Return a view of the sample stored at a position."""
+        if not 0 <= position < len(self._ids):
+            raise IndexError(f"Position {position} out of range for a store of {len(self._ids)} samples")
+        shard, row = divmod(position, self.shard_size)
+        return self._shard(shard)[row]
+
+    def read_batch(self, start, stop) -> np.ndarray:
+        """
+        Return samples start to stop (excluded) as one array.
+
+        The result is a view of the memory map when the range lies in a single shard,
+        a copy otherwise.
+        """
+        start, stop, _ = slice(start, stop).indices(len(self._ids))
+        stop = max(start, stop)
+        first_shard, first_row = divmod(start, self.shard_size)
+        last_shard = (stop - 1) // self.shard_size if stop > start else first_shard
+        if first_shard == last_shard:
+            return self._shard(first_shard)[first_row:first_row + stop - start]
+
+        parts = []
+        for shard in range(first_shard, last_shard + 1):
+            begin = max(start - shard*self.shard_size, 0)
+            end = min(stop - shard*self.shard_size, self.shard_size)
+            parts.append(self._shard(shard)[begin:end])
+        return np.concatenate(parts)
+
+    def to_array(self) -> np.ndarray:
+        """Return every sample as one array (a view when the store fits in one shard)."""
+        return self.read_batch(0, len(self._ids))
+
+    def append(self, sample, sample_id=None) -> int:
+        """
+        Append one sample. The index is not written until flush() is called.
+
+        Args:
+            sample: Array of the store sample shape
+            sample_id: Unique id of the sample (default: its position)
+
+        Returns:
+            int: Position of the new sample
+
+        Raises:
+            ValueError: If the shape does not match or the id already exists
+        """
+        sample = np.asarray(sample)
+        if sample.shape != self.sample_shape:
+            raise ValueError(f"Sample has shape {sample.shape}, store expects {self.sample_shape}")
+        position = len(self._ids)
+        sample_id = position if sample_id is None else sample_id
+        if sample_id in self._positions:
+            raise ValueError(f"Sample id {sample_id!r} already in store {self.root}")
+
+        shard, row = divmod(position, self.shard_size)
+        self._shard(shard, writable=True)[row] = sample
+        self._ids.append(sample_id)
+        self._positions[sample_id] = position
+        return position
+
+    def extend(self, samples, sample_ids=None) -> None:
+        """Append several samples, then write the index."""
+        if sample_ids is None:
+            for sample in samples:
+                self.append(sample)
+        else:
+            for sample, sample_id in zip(samples, sample_ids):
+                self.append(sample, sample_id)
+        self.flush()
+
+    def flush(self) -> None:
+        """Write pending samples to disk and atomically replace the index file."""
+        for shard in self._shards:
+            if shard is not None and shard.mode in self.WRITABLE_MODES:
+                shard.flush()
+
+        index = {
+            "sample_shape": list(self.sample_shape),
+            "dtype": self.dtype.str,
+            "shard_size": self.shard_size,
+            "shards": [self.SHARD_PATTERN.format(i) for i in range(-(-len(self._ids) // self.shard_size))],
+            "ids": self._ids,
+        }
+        index_path = self.root / self.INDEX_FILE
+        tmp_path = index_path.with_suffix(".tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, index_path)
+
+    def _shard(self, shard, writable=False) -> np.ndarray:
+        """Return the memory map of a shard, creating the shard file when appending past the last one."""
+        while len(self._shards) <= shard:
+            self._shards.append(None)
+        mapped = self._shards[shard]
+        if mapped is not None and (not writable or mapped.mode in self.WRITABLE_MODES):
+            return mapped
+
+        path = self.root / self.SHARD_PATTERN.format(shard)
+        if writable and not path.exists():
+            mapped = np.lib.format.open_memmap(path, mode='w+', dtype=self.dtype,
+                                               shape=(self.shard_size,) + self.sample_shape)
+        else:
+            mapped = np.load(path, mmap_mode='r+' if writable else 'r', allow_pickle=False)
+        self._shards[shard] = mapped
+        return mapped
+
+
+def convert_pickle_directory(directory, store_root, sample_shape=(160, 160), dtype=None) -> ArrayDatasetStore:
+    """
+    Convert a directory of one-array pickle files into an array store.
+
+    Args:
+        directory: Directory of .pkl files, each holding one array
+        store_root: Directory of the store to create or extend
+        sample_shape: Shape every array is reshaped to
+        dtype: Dtype of the store (default: dtype of the first array)
+
+    Returns:
+        ArrayDatasetStore: The filled store, sample ids being the file names
+    """
+    from image_processing import load_pkl_file
+
+    filenames = sorted(f for f in os.listdir(directory) if os.path.isfile(os.path.join(directory, f)))
+    store = None
+    for filename in filenames:
+        sample = np.reshape(load_pkl_file(os.path.join(directory, filename)), sample_shape)
+        if store is None:
+            store = ArrayDatasetStore(store_root, sample_shape, dtype or sample.dtype)
+        if filename not in store:
+            store.append(sample, filename)
+    if store is None:
+        store = ArrayDatasetStore(store_root, sample_shape, dtype or np.float64)
+    store.flush()
+    return store
+
+
+def convert_image_directory(directory, store_root, sample_shape=(160, 160)) -> ArrayDatasetStore:
+    """
+    Convert a directory of images into a uint8 grayscale array store.
+
+    Args:
+        directory: Directory of .png, .jpg or .bmp images
+        store_root: Directory of the store to create or extend
+        sample_shape: Shape every image is reshaped to
+
+    Returns:
+        ArrayDatasetStore: The filled store, sample ids being the file names
+    """
+    from PIL import Image
+
+    filenames = sorted(f for f in os.listdir(directory) if os.path.isfile(os.path.join(directory, f)))
+    store = ArrayDatasetStore(store_root, sample_shape, np.uint8)
+    for filename in filenames:
+        if filename in store:
+            continue
+        with Image.open(os.path.join(directory, filename)) as img:
+            sample = np.reshape(np.array(img.convert("L")), sample_shape)
+        store.append(sample, filename)
+    store.flush()
+    return store
+
+
+def _decode_image(path, sample_shape) -> np.ndarray:
+    """Decode one image file into a uint8 grayscale array (run in a worker process)."""
+    from PIL import Image
+
+    with Image.open(path) as img:
+        return np.reshape(np.array(img.convert("L")), sample_shape)
+
+
+def directory_listing(directory) -> list:
+    """
+    Return the signature of every file of a directory, sorted by name.
+
+    Returns:
+        list: (filename, size, mtime_ns) tuples
+    """
+    listing = []
+    for entry in os.scandir(directory):
+        if entry.is_file():
+            stat = entry.stat()
+            listing.append((entry.name, stat.st_size, stat.st_mtime_ns))
+    return sorted(listing)
+
+
+def listing_hash(listing, sample_shape=None) -> str:
+    """
+    Return a hash identifying a directory listing (see directory_listing) and the decoding of its files.
+
+    Args:
+        listing: Directory listing
+        sample_shape: Shape the images are reshaped to, None to hash the listing alone
+    """
+    key = listing if sample_shape is None else {"listing": listing, "sample_shape": list(sample_shape), "decoding": DECODING}
+    return hashlib.sha1(json.dumps(key).encode("utf-8")).hexdigest()[:16]
+
+
+def _iter_samples(directory, listing, previous, sample_shape, workers):
+    """
+    Yield the samples of a listing in order, read from previous stores or decoded by a process pool.
+
+    Files are submitted to the pool a few at a time, so only a bounded number of decoded images
+    wait in memory to be written, whatever the size of the directory.
+    """
+    def load(item):
+        return item.result() if isinstance(item, Future) else item[0].read(item[1])
+
+    n_decoded = sum(1 for signature in listing if signature not in previous)
+    if n_decoded <= 1 or workers == 1:
+        for signature in listing:
+            yield load(previous[signature]) if signature in previous \
+                else _decode_image(os.path.join(directory, signature[0]), sample_shape)
+        return
+
+    window = 4 * (workers or os.cpu_count() or 1)
+    with ProcessPoolExecutor(workers) as pool:
+        pending = deque()
+        for signature in listing:
+            pending.append(previous[signature] if signature in previous
+                           else pool.submit(_decode_image, os.path.join(directory, signature[0]), sample_shape))
+            if len(pending) >= window:
+                yield load(pending.popleft())
+        while pending:
+            yield load(pending.popleft())
+
+
+def load_image_directory_cached(directory, cache_root, sample_shape=(160, 160), workers=None) -> ArrayDatasetStore:
+    """
+    Load a directory of images as a uint8 array store, decoding only files missing from the cache.
+
+    Decoded images are cached under cache_root in a store keyed by a hash of the directory
+    listing (file names, sizes and modification times), the sample shape and the decoding. An
+    unchanged directory is opened straight from its memory-mapped store. When files were added,
+    removed or modified, a new store is built in listing order: unchanged samples are copied from
+    the previous store and only the changed files are decoded, by a pool of worker processes, each
+    sample being written to the store as soon as it is ready. The previous store is then removed.
+
+    Args:
+        directory: Directory of .png, .jpg or .bmp images
+        cache_root: Directory holding the decoded caches of all image directories
+        sample_shape: Shape every image is reshaped to
+        workers: Number of decoding processes (default: number of CPUs)
+
+    Returns:
+        ArrayDatasetStore: Store of the images in sorted file name order, sample ids being the file names
+    """
+    listing = directory_listing(directory)
+    cache_dir = Path(cache_root) / hashlib.sha1(os.path.abspath(directory).encode("utf-8")).hexdigest()[:16]
+    store_root = cache_dir / listing_hash(listing, sample_shape)
+    if (store_root / ArrayDatasetStore.INDEX_FILE).exists():
+        return ArrayDatasetStore(store_root, sample_shape, np.uint8)
+
+    # unchanged samples are found in previous caches of the directory by their signature
+    previous = {}
+    for previous_root in (cache_dir.iterdir() if cache_dir.is_dir() else []):
+        listing_path = previous_root / LISTING_FILE
+        if not listing_path.exists() or not (previous_root / ArrayDatasetStore.INDEX_FILE).exists():
+            continue
+        with open(listing_path, 'r', encoding='utf-8') as f:
+            previous_listing = [tuple(signature) for signature in json.load(f)]
+        previous_store = ArrayDatasetStore(previous_root)
+        if previous_store.sample_shape == tuple(sample_shape) and previous_store.dtype == np.uint8:
+            for position, signature in enumerate(previous_listing):
+                previous.setdefault(signature, (previous_store, position))
+
+    # the new store is built aside and renamed once complete, so an interrupted build is never loaded
+    tmp_root = cache_dir / (store_root.name + ".tmp")
+    shutil.rmtree(tmp_root, ignore_errors=True)
+    store = ArrayDatasetStore(tmp_root, sample_shape, np.uint8, shard_size=max(len(listing), 1))
+    for signature, sample in zip(listing, _iter_samples(directory, listing, previous, sample_shape, workers)):
+        store.append(sample, signature[0])
+    store.flush()
+    with open(tmp_root / LISTING_FILE, 'w', encoding='utf-8') as f:
+        json.dump(listing, f)
+    del store
+    previous.clear()
+    shutil.rmtree(store_root, ignore_errors=True) # a partial store left by an interrupted run, os.replace needs it gone
+    os.replace(tmp_root, store_root)
+
+    for stale_root in cache_dir.iterdir():
+        if stale_root != store_root:
+            shutil.rmtree(stale_root, ignore_errors=True)
+    return ArrayDatasetStore(store_root)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Convert a directory of pickle files or images into an array store.")
+    parser.add_argument("source_type", choices=["pkl", "images"], help="type of the files in the source directory")
+    parser.add_argument("directory", help="directory of .pkl files or images")
+    parser.add_argument("store_root", help="directory of the store to create or extend")
+    args = parser.parse_args()
+
+    if args.source_type == "pkl":
+        converted = convert_pickle_directory(args.directory, args.store_root)
+    else:
+        converted = convert_image_directory(args.directory, args.store_root)
+    print(f"{len(converted)} samples in {converted.root}")
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""Decoder-only fine-tuning on cached activations of a frozen encoder.
+
+The frozen layers of a model are split off into an encoder run once over the dataset; the
+activations it hands to the trainable layers (bottleneck and skip connections) are stored in
+memory-mapped .npy files, and a decoder-only model sharing the trainable layers is trained on them.
+"""
+
+import hashlib
+import os
+from pathlib import Path
+
+import numpy as np
+import tensorflow as tf
+
+
+COMPLETE_FILE = "complete"  # written once every feature file of a cache is filled
+
+
+def _inbound_layers(layer):
+    '''Return the layers feeding a layer of a functional model.
+    Reads the private node structure of tf.keras 2, which Keras 3 no longer has.'''
+    nodes = getattr(layer, "_inbound_nodes", None)
+    if not nodes or not hasattr(nodes[0], "inbound_layers"):
+        raise NotImplementedError(f"Cannot read the inputs of layer {layer.name}: splitting a model needs a functional "
+                                  "tf.keras 2 model, Keras 3 models are not supported")
+    return tf.nest.flatten(nodes[0].inbound_layers)
+
+
+def split_frozen_model(model):
+    '''Split a functional model into its frozen encoder and a decoder-only model of its trainable layers.
+    The decoder shares the layers (and weights) of the model, so training it trains the model. The encoder
+    runs in inference mode, so the dropout layers it contains are no longer applied while fine-tuning.
+    Parameters
+    ----------
+    model: tf.keras.Model
+        functional model whose encoder layers have trainable = False
+
+    Returns (encoder, decoder): encoder maps the model inputs to the frozen activations read by trainable
+    layers, decoder maps those activations to the model outputs
+    '''
+    layers = model.layers
+    trainable = {layer.name for layer in layers
+                 if layer.trainable and not isinstance(layer, tf.keras.layers.InputLayer)}
+
+    # frozen layers must not depend on trainable ones, or cached activations would go stale while training
+    for layer in layers:
+        if layer.name not in trainable and any(parent.name in trainable for parent in _inbound_layers(layer)):
+            raise ValueError(f"Frozen layer {layer.name} depends on trainable layers, its activations cannot be cached")
+    output_layers = [model.get_layer(name) for name in model.output_names]
+    if any(layer.name not in trainable for layer in output_layers):
+        raise ValueError("Model outputs are computed by frozen layers, there is no decoder to train")
+
+    frontier = []
+    for layer in layers:
+        if layer.name in trainable:
+            frontier += [parent for parent in _inbound_layers(layer) if parent.name not in trainable and parent not in frontier]
+    frontier.sort(key=layers.index)
+    encoder = tf.keras.Model(model.inputs, [layer.output for layer in frontier], name=model.name + "_encoder")
+
+    tensors = {layer.name: tf.keras.Input(shape=layer.output.shape[1:], name=layer.name + "_features")
+               for layer in frontier}
+    decoder_inputs = [tensors[layer.name] for layer in frontier]
+    for layer in layers:
+        if layer.name in trainable:
+            inputs = [tensors[parent.name] for parent in _inbound_layers(layer)]
+            tensors[layer.name] = layer(inputs[0] if len(inputs) == 1 else inputs)
+    decoder = tf.keras.Model(decoder_inputs, [tensors[layer.name] for layer in output_layers], name=model.name + "_decoder")
+    return encoder, decoder
+
+
+def _cache_key(encoder, images, dtype):
+    '''Hash the encoder weights, the input images and the storage dtype, which together determine the cached activations.'''
+    digest = hashlib.sha1(np.dtype(dtype).str.encode("utf-8"))
+    for weight in encoder.weights:
+        digest.update(np.ascontiguousarray(weight.numpy()).tobytes())
+    digest.update(str(np.shape(images)).encode("utf-8"))
+    for start in range(0, len(images), 256):
+        digest.update(np.ascontiguousarray(images[start:start+256]).tobytes())
+    return digest.hexdigest()[:16]
+
+
+def cache_encoder_features(encoder, images, cache_root, batch_size=32, dtype=np.float32):
+    '''Run the frozen encoder once over a set of images and store its activations in memory-mapped files.
+    A cache is reused as long as the encoder weights and the images are the same.
+    Parameters
+    ----------
+    encoder: tf.keras.Model
+        encoder returned by split_frozen_model
+    images: np.ndarray
+        model inputs of shape (N, 160, 160, 1)
+    cache_root: str
+        directory of the feature caches
+    batch_size: int
+        number of images per encoder call
+    dtype: np.dtype
+        dtype of the stored activations, np.float16 halving the size of the cache
+
+    Returns list of read-only memory-mapped arrays, one per encoder output, of shape (N, *output shape)
+    '''
+    cache_dir = Path(cache_root) / _cache_key(encoder, images, dtype)
+    paths = [cache_dir / f"{name}.npy" for name in encoder.output_names]
+    if not (cache_dir / COMPLETE_FILE).exists():
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        features = [np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(len(images),) + tuple(output.shape[1:]))
+                    for path, output in zip(paths, encoder.outputs)]
+        for start in range(0, len(images), batch_size):
+            batch = np.asarray(images[start:start+batch_size], dtype=np.float32)
+            activations = tf.nest.flatten(encoder(batch, training=False))
+            for feature, activation in zip(features, activations):
+                feature[start:start+len(batch)] = activation.numpy()
+        for feature in features:
+            feature.flush()
+        del features
+        (cache_dir / COMPLETE_FILE).touch()
+    return [np.load(path, mmap_mode='r') for path in paths]
+
+
+def feature_dataset(features, masks, batch_size, shuffle=False, seed=None):
+    '''Build a tf.data pipeline of (activations, mask) batches read from the memory-mapped feature cache.
+    Parameters
+    ----------
+    features: list
+        arrays returned by cache_encoder_features
+    masks: np.ndarray
+        masks of 0 and 255 values, of shape (N, 160, 160, 1), divided by 255 in the pipeline
+    batch_size: int
+        size of the batches
+    shuffle: bool
+        visit the samples in a new random order every epoch
+
+    Returns tf.data.Dataset of ((activation, ...), mask) batches
+    '''
+    rng = np.random.default_rng(seed)
+
+    def batches():
+        order = rng.permutation(len(masks)) if shuffle else np.arange(len(masks))
+        for start in range(0, len(order), batch_size):
+            index = np.sort(order[start:start+batch_size]) # memory maps read faster in order
+            yield (tuple(np.asarray(feature[index]) for feature in features),
+                   np.asarray(masks[index], dtype=np.float32) / 255) # need 0 or 1
+
+    signature = (tuple(tf.TensorSpec((None,) + feature.shape[1:], tf.as_dtype(feature.dtype)) for feature in features),
+                 tf.TensorSpec((None,) + masks.shape[1:], tf.float32))
+    dataset = tf.data.Dataset.from_generator(batches, output_signature=signature)
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+def cached_feature_datasets(model, x_training, y_training, x_validation, y_validation, cache_root, batch_size,
+                            encoder_batch_size=32, seed=None, dtype=np.float32):
+    '''Split a model with a frozen encoder, cache the encoder activations of the training and validation sets,
+    and return the decoder to train with the datasets reading those activations.
+    See split_frozen_model, cache_encoder_features and feature_dataset.
+
+    Returns (decoder, training_dataset, validation_dataset)
+    '''
+    encoder, decoder = split_frozen_model(model)
+    training_features = cache_encoder_features(encoder, x_training, os.path.join(cache_root, "training"),
+                                               encoder_batch_size, dtype)
+    validation_features = cache_encoder_features(encoder, x_validation, os.path.join(cache_root, "validation"),
+                                                 encoder_batch_size, dtype)
+    return (decoder,
+            feature_dataset(training_features, y_training, batch_size, shuffle=True, seed=seed),
+            feature_dataset(validation_features, y_validation, batch_size))
@@ -3,15 +3,21 @@
 """
 
 from PIL import Image 
+import argparse
+import glob
+import os
 import pickle
-import tensorflow as tf
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-import matplotlib.pyplot as plt
-import cProfile, pstats
-from image_processing import regular_sample, shape_to, save_img_from_array
+from image_processing import (regular_sample, shape_to, save_img_from_array, create_img_from_predictions, predict_tiled,
+                              make_predictions, make_batch_predictions, threshold_map)
+from metrics import StreamingMetrics, segmentation_scores
+from model_registry import get_model
 
 
-def prepare_prediction(us_path, mask_path, model_path, seg_saving_path, from_image, prepared=True):    
+def prepare_prediction(us_path, mask_path, model_path, seg_saving_path, from_image, prepared=True, tiled=False):    
     ''' Allow to prepare ultrasound images before running a semantic segmentation. 
     Parameters
     ----------
@@ -27,6 +33,8 @@ def prepare_prediction(us_path, mask_path, model_path, seg_saving_path, from_ima
         True if the ultrasound data is provided as a image saved as a .jpg, .png or .bmp file, False if it is provided as an array saved in a .pkl file 
     prepared: bool
         True if the data already corresponds to the CNN input format, False if not.
+    tiled: bool
+        True to segment the image at its native resolution with overlapping tiles, in which case it is not resized.
         '''
     if from_image == True:
         original = np.array(Image.open(us_path).convert("L"))
@@ -35,61 +43,193 @@ def prepare_prediction(us_path, mask_path, model_path, seg_saving_path, from_ima
     elif from_image == False: 
         with open(us_path, "rb") as pkl_file:
             original = pickle.load(pkl_file)
-        with open("mask_path", "rb") as pkl_file2:
+        with open(mask_path, "rb") as pkl_file2:
             mask = pickle.load(pkl_file2)        
             
-    elif prepared == False:
-        original = regular_sample(original)
-        original = shape_to(original) 
+    if prepared == False and tiled == False:
+        original = shape_to(regular_sample(original))
+        mask = shape_to(regular_sample(mask))
     
-    make_prediction(original, mask, model_path, seg_saving_path)
+    make_prediction(original, mask, model_path, seg_saving_path, tiled)
     
 
-def make_prediction(img_array, mask_array, model_path, seg_saving_path):
+def make_prediction(img_array, mask_array, model_path, seg_saving_path, tiled=False):
     '''Run semantic segmentation of ultrasound images. 
         Parameters
     ----------
-    us_path: str
-        path leading to the ultrasound image
-    mask_path: str
-        path leading to the mask of the ultrasound image
+    img_array: 2D array
+        ultrasound image
+    mask_array: 2D array
+        reference mask of the ultrasound image used to score the segmentation, or None
     model_path: str
         path leading to the CNN used to make the predictions
     seg_saving_path: str
         path choosen to save the segmentated image
+    tiled: bool
+        segment the image at its native resolution with overlapping 160x160 tiles
+        
+    Returns dict of the segmentation scores (see metrics.scores_from_counts), None without mask
     '''
-
-    loaded_model = tf.keras.models.load_model(model_path, compile=False)
-    
-    # calculate prediction errors
-    lr_schedule = tf.keras.optimizers.schedules.ExponentialDecay(5e-4, decay_steps=1e5, decay_rate=2e-05, staircase=True)
-    loaded_model.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=lr_schedule),
-              loss=tf.keras.losses.BinaryCrossentropy(from_logits=True),
-              metrics=[tf.keras.metrics.MeanIoU(num_classes=2)]) 
-    loaded_model.evaluate(np.reshape(img_array, (1, 160, 160)), np.reshape(mask_array/255, (1, 160, 160)), batch_size=2)
+    loaded_model = get_model(model_path)
     
     # perform segmentation
-    predictions = loaded_model.predict(np.reshape(img_array, (1, 160, 160))) 
-    predictions = np.reshape(predictions, (160, 160)) # Restore predictions array to correct format
+    if tiled:
+        predictions = predict_tiled(img_array, loaded_model)
+    else:
+        predictions = make_predictions(img_array, loaded_model)
+    
+    # calculate prediction errors from the prediction already made
+    scores = None
+    if mask_array is not None:
+        scores = {name: float(value) for name, value in segmentation_scores(predictions, mask_array).items()}
+        print(", ".join(f"{name}: {value:.4f}" for name, value in scores.items()))
+    
     # Replace prediction with pixel value it approximates 
-    classified_predictions = np.ones((160, 160))
-    for i in range(160):
-        for j in range(160):
-            if predictions[(i, j)] < 0.5:
-                classified_predictions[(i, j)] = 0 # black
-                
-            else: 
-                classified_predictions[(i, j)] = 255 # white
+    classified_predictions = create_img_from_predictions(predictions)
     save_img_from_array(classified_predictions, seg_saving_path) # save segmented image
+    return scores
 
     
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff")
+
+
+def list_input_images(source):
+    '''List the images to segment, sorted by path.
+    Parameters
+    ----------
+    source: str
+        directory of images, or glob pattern such as "study/*.png"
+    '''
+    if os.path.isdir(source):
+        paths = [os.path.join(source, f) for f in os.listdir(source)]
+    else:
+        paths = glob.glob(source)
+    return sorted(p for p in paths if os.path.isfile(p) and p.lower().endswith(IMAGE_EXTENSIONS))
+
+
+def load_and_prepare(us_path):
+    '''Decode an ultrasound image (or its mask) and bring it to the CNN input format.'''
+    with Image.open(us_path) as img:
+        original = np.array(img.convert("L"))
+    return shape_to(regular_sample(original)).astype(np.float32)
+
+
+def _load_job(us_path, mask_path):
+    '''Decode an ultrasound image and, when scoring, its reference mask.'''
+    return load_and_prepare(us_path), (load_and_prepare(mask_path) if mask_path else None)
+
+
+def save_mask(mask, seg_saving_path):
+    '''Save a mask under a temporary name, then rename it, so that an interrupted run never leaves
+    a truncated mask that --resume would skip.'''
+    root, extension = os.path.splitext(seg_saving_path)
+    tmp_path = root + ".tmp" + extension # keeps the extension PIL picks the format from
+    save_img_from_array(mask, tmp_path)
+    os.replace(tmp_path, seg_saving_path)
+
+
+def segment_directory(source, model_path, output_dir, naming_pattern="{basename}_mask.png", batch_size=16,
+                      decode_workers=4, write_workers=2, queue_size=64, resume=False, mask_dir=None):
+    '''Segment every image of a directory (or glob pattern) and save the masks as PNG files.
+    Decoding and preprocessing run on a thread pool ahead of the CNN, masks are encoded and written
+    on another thread pool behind it. At most queue_size images wait in each of the two queues.
+    Parameters
+    ----------
+    source: str
+        directory of ultrasound images, or glob pattern
+    model_path: str
+        path leading to the CNN used to make the predictions
+    output_dir: str
+        directory where the masks are saved
+    naming_pattern: str
+        mask filename, {basename} being replaced by the image filename without extension
+    batch_size: int
+        number of images given to the CNN in one call
+    decode_workers, write_workers: int
+        number of threads decoding images and writing masks
+    queue_size: int
+        maximum number of images decoded ahead of the CNN, and of masks waiting to be written
+    resume: bool
+        skip the images whose mask already exists in output_dir
+    mask_dir: str
+        directory of reference masks named like the images, to score the segmentation
+        
+    Returns dict with the number of segmented and skipped images, the elapsed time, the throughput
+    and, with mask_dir, the scores accumulated over the images (see metrics.StreamingMetrics)
+    '''
+    start = time.perf_counter()
+    os.makedirs(output_dir, exist_ok=True)
+    jobs = []
+    skipped = 0
+    for us_path in list_input_images(source):
+        basename = os.path.splitext(os.path.basename(us_path))[0]
+        seg_saving_path = os.path.join(output_dir, naming_pattern.format(basename=basename))
+        if resume and os.path.exists(seg_saving_path):
+            skipped += 1
+            continue
+        mask_path = os.path.join(mask_dir, os.path.basename(us_path)) if mask_dir else None
+        jobs.append((us_path, mask_path, seg_saving_path))
+
+    loaded_model = get_model(model_path) if jobs else None
+    streaming_metrics = StreamingMetrics() if mask_dir else None
+    queue_size = max(queue_size, batch_size)
+    with ThreadPoolExecutor(decode_workers) as decode_pool, ThreadPoolExecutor(write_workers) as write_pool:
+        remaining_jobs = iter(jobs)
+        decoding = deque() # (mask path, future of the prepared image and reference mask), in input order
+        writing = deque()
+
+        def fill_decode_queue():
+            while len(decoding) < queue_size:
+                job = next(remaining_jobs, None)
+                if job is None:
+                    return
+                decoding.append((job[2], decode_pool.submit(_load_job, job[0], job[1])))
+
+        fill_decode_queue()
+        while decoding:
+            batch = [decoding.popleft() for _ in range(min(batch_size, len(decoding)))]
+            fill_decode_queue()
+            decoded = [future.result() for _, future in batch]
+            predictions = make_batch_predictions([img for img, _ in decoded], loaded_model, batch_size)
+            if streaming_metrics is not None:
+                streaming_metrics.update(predictions, np.stack([mask for _, mask in decoded]))
+            masks = threshold_map(predictions)
+            for (seg_saving_path, _), mask in zip(batch, masks):
+                while len(writing) >= queue_size:
+                    writing.popleft().result()
+                writing.append(write_pool.submit(save_mask, mask, seg_saving_path))
+        while writing:
+            writing.popleft().result()
+
+    elapsed = time.perf_counter() - start
+    summary = {"segmented": len(jobs), "skipped": skipped, "seconds": elapsed,
+               "images_per_second": len(jobs) / elapsed if elapsed > 0 else 0.0}
+    if streaming_metrics is not None:
+        summary["scores"] = streaming_metrics.result()
+    return summary
+
+
 def main():
-    us_path = ""
-    mask_path = ""
-    model_path = ""
-    seg_saving_path = ""
-    from_image = True
-    prepared = False
-    prepare_prediction(us_path, mask_path, model_path, seg_saving_path, from_image, prepared)
+    parser = argparse.ArgumentParser(description="Segment a directory of ultrasound images with a CNN.")
+    parser.add_argument("source", help="directory of ultrasound images, or glob pattern such as 'study/*.png'")
+    parser.add_argument("model_path", help="saved CNN model")
+    parser.add_argument("output_dir", help="directory where the masks are saved")
+    parser.add_argument("--naming-pattern", default="{basename}_mask.png", help="mask filename pattern")
+    parser.add_argument("--batch-size", type=int, default=16, help="images per CNN call")
+    parser.add_argument("--decode-workers", type=int, default=4, help="threads decoding images")
+    parser.add_argument("--write-workers", type=int, default=2, help="threads writing masks")
+    parser.add_argument("--queue-size", type=int, default=64, help="images buffered before and after the CNN")
+    parser.add_argument("--resume", action="store_true", help="skip images whose mask already exists")
+    parser.add_argument("--mask-dir", help="directory of reference masks named like the images, to score the segmentation")
+    args = parser.parse_args()
+
+    summary = segment_directory(args.source, args.model_path, args.output_dir, args.naming_pattern, args.batch_size,
+                                args.decode_workers, args.write_workers, args.queue_size, args.resume, args.mask_dir)
+    print(f"{summary['segmented']} images segmented, {summary['skipped']} skipped, "
+          f"{summary['seconds']:.1f} s ({summary['images_per_second']:.1f} images/s)")
+    if "scores" in summary:
+        print(", ".join(f"{name}: {value:.4f}" for name, value in summary["scores"].items() if name != "images"))
     
-main()   
\ No newline at end of file
+
+if __name__ == '__main__':
+    main()
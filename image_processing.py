@@ -1,144 +1,235 @@
 import numpy as np
-from scipy import signal
+from functools import lru_cache
 import pickle
-from PIL import Image
-import matplotlib.pyplot as plt
+
+# scipy, PIL and matplotlib are imported where they are used, to keep this module fast to import
+
+def _centered_margins(size, target):
+    '''Split the difference between size and target into (before, after) margins.
+    The odd pixel goes before, as the top/left side is always handled first.'''
+    diff = abs(size - target)
+    return (diff + 1) // 2, diff // 2
+
 
 def crop_from_array(rf, max_width, max_height):
     '''Crop an image array to a chosen shape. 
+    Rows and columns are removed alternately from top/left and bottom/right, the
+    final offsets are computed once and a view of the input is returned.
     Parameters:
     ----------
     rf: np.ndarray
         image
     '''
     
-    (height, width) = np.shape(rf)
-    high_cut = True # Start by cutting from top and left, then alternate with cutting from bottom and right
-    while width > max_width or height > max_height:
-        if width > max_width and height > max_height:
-            # cut along both axes
-            if high_cut == True:
-                rf = np.delete(rf, 0, axis=0) # cut off line 0
-                rf = np.delete(rf, 0, axis=1) # cut off column 0
-                high_cut = False
-            else:
-                rf = np.delete(rf, height-1, axis=0) # cut off last line
-                rf = np.delete(rf, width-1, axis=1) # cut off last column 
-                high_cut = True      
-        elif width > max_width and height <= max_height: # If width is not correct
-            # cut along axis = 1 only
-            if high_cut == True:
-                rf = np.delete(rf, 0, axis=1) # cut off 1st column
-                high_cut = False
-            else: 
-                rf = np.delete(rf, width-1, axis=1) # cut off last column
-                high_cut = True
-        elif width <= max_width and height > max_height: # If height is not correct
-        # cut along axis = 0 only 
-            if high_cut == True:
-                rf = np.delete(rf, 0, axis=0) # cut off 1st line
-                high_cut = False
-            else: 
-                rf = np.delete(rf, height-1, axis=0) # cut off last line
-                high_cut = True
-        (height, width) = np.shape(rf)
+    (height, width) = np.shape(rf)[-2:]
+    top, bottom = _centered_margins(height, max_height) if height > max_height else (0, 0)
+    left, right = _centered_margins(width, max_width) if width > max_width else (0, 0)
 
-    return rf
+    return rf[..., top:height-bottom, left:width-right]
 
 
 def add_pixels(rf, max_width, max_height):
     '''Add black pixels to get an image array to shape (160, 160) 
+    Pixels are added alternately at top/left and bottom/right in a single allocation.
+    The bottom/right pixels are inserted before the last line/column of the image,
+    which is kept on the border of the output.
     Parameters:
     ----------
     rf: np.ndarray
         image
     '''
     (height, width) = np.shape(rf)
-    high_add = True # Start by adding pixels at top and left, then alternate with bottom and right
-    while width < max_width or height < max_height:
-        if width < max_width and height < max_height:
-            # add along both axes
-            if high_add == True:
-                rf = np.insert(rf, 0, 0,  axis=0) # cut off line 0
-                rf = np.insert(rf, 0, 0, axis=1) # cut off column 0
-                high_add = False
-            else:
-                rf = np.insert(rf, height-1, 0, axis=0) # cut off last line
-                rf = np.insert(rf, width-1, 0, axis=1) # cut off last column 
-                high_add = True      
-        elif width < max_width and height >= max_height: # If width is not correct
-            # cut along axis = 1 only
-            if high_add == True:
-                rf = np.insert(rf, 0, 0, axis=1) # cut off 1st column
-                high_add = False
-            else: 
-                rf = np.insert(rf, width-1, 0, axis=1) # cut off last column
-                high_add = True
-        elif width >= max_width and height < max_height: # If height is not correct
-        # cut along axis = 0 only 
-            if high_add == True:
-                rf = np.insert(rf, 0, 0, axis=0) # cut off 1st line
-                high_add = False
-            else: 
-                rf = np.insert(rf, height-1, 0, axis=0) # cut off last line
-                high_add = True
-        (height, width) = np.shape(rf)
+    if height >= max_height and width >= max_width:
+        return rf
+
+    top, bottom = _centered_margins(height, max_height) if height < max_height else (0, 0)
+    left, right = _centered_margins(width, max_width) if width < max_width else (0, 0)
+    padded = np.zeros((height + top + bottom, width + left + right), dtype=rf.dtype)
+    _place_into(rf, padded)
         
-    return rf
+    return padded
+
+
+def _place_into(rf, out):
+    '''Write an image (or a stack of images) into a zero-filled array that is at least as
+    large on both axes, with the same placement as add_pixels.'''
+    (height, width) = rf.shape[-2:]
+    (new_height, new_width) = out.shape[-2:]
+    if (height, width) == (new_height, new_width):
+        out[...] = rf
+        return out
+
+    # the image is written as four blocks with slices: all but its last line and column, centered,
+    # then its last line and last column moved to the border
+    top = _centered_margins(height, new_height)[0]
+    left = _centered_margins(width, new_width)[0]
+    out[...] = 0
+    out[..., top:top+height-1, left:left+width-1] = rf[..., :-1, :-1]
+    out[..., top:top+height-1, new_width-1] = rf[..., :-1, -1]
+    out[..., new_height-1, left:left+width-1] = rf[..., -1, :-1]
+    out[..., new_height-1, new_width-1] = rf[..., -1, -1]
+    return out
 
 
 def shape_to(rf, max_width=160, max_height=160):
-    '''Reshape an image array by adding or cutting pixels. '''
-    (height, width) = rf.shape
-    if height < max_height and width < max_width:
-        rf = add_pixels(rf, max_width, max_height)
-    elif height > max_height and width > max_width:
-        rf = crop_from_array(rf, max_width, max_height)
-    else:
-        rf = add_pixels(rf, max_width, max_height)
-        rf = crop_from_array(rf, max_width, max_height)
+    '''Reshape an image array by adding or cutting pixels. 
+    Returns a view when only cropping is needed, a single new array otherwise.'''
+    rf = crop_from_array(rf, max_width, max_height)
+    rf = add_pixels(rf, max_width, max_height)
         
     return rf
 
 
 def my_resample2(rf, width, height):
     '''Reduce size array to approximately widthxheight size. Need to complete with shape_to function.'''
-    rf = signal.resample_poly(rf, 1, round(np.shape(rf)[0]/height)) 
-    rf = signal.resample_poly(rf, 1, round(np.shape(rf)[1]/width), axis=1)
-    return rf
+    return antialiased_sample(rf, width, height, ftype='poly', dtype=np.float64)
 
 
 def my_resample3(rf, width, height):
     '''Reduce size array to approximately widthxheight size. Need to complete with shape_to function. '''
-    rf = signal.decimate(rf, round(np.shape(rf)[0]/height), ftype='fir', axis=0)
-    rf = signal.decimate(rf, round(np.shape(rf)[1]/width), ftype='fir', axis=1)
+    return antialiased_sample(rf, width, height, ftype='fir', dtype=np.float64)
+
+
+@lru_cache(maxsize=32)
+def _decimation_matrix(length, down, ftype, dtype):
+    '''Build the (ceil(length/down), length) matrix low-pass filtering and decimating an axis.
+    Rows are the FIR filter centered on every kept sample, zero outside the image, which is what
+    signal.resample_poly (ftype 'poly') or signal.decimate (ftype 'fir') compute for this axis.'''
+    from scipy import signal
+    if ftype == 'poly':
+        taps = signal.firwin(20*down + 1, 1/down, window=('kaiser', 5.0))
+    elif ftype == 'fir':
+        taps = signal.firwin(20*down + 1, 1/down, window='hamming')
+    else:
+        raise ValueError(f"Unknown filter type {ftype!r}, expected 'poly' or 'fir'")
+    half_len = (len(taps) - 1) // 2
+
+    n_out = -(-length // down)
+    tap_index = np.arange(n_out)[:, np.newaxis]*down + half_len - np.arange(length)
+    inside = (tap_index >= 0) & (tap_index < len(taps))
+    matrix = np.where(inside, taps[np.clip(tap_index, 0, len(taps)-1)], 0).astype(dtype)
+    matrix.setflags(write=False)
+    return matrix
+
+
+def antialiased_sample(rf, max_width=160, max_height=160, ftype='poly', dtype=np.float32):
+    '''Reduce size array like regular_sample, with a low-pass filter before striding to avoid aliasing.
+    The filters of each (input size, target size) pair are designed once and cached, and both axes
+    are filtered in a single pass of two matrix products, on an image or a stack of images.
+    Need to complete with shape_to function.
+    Parameters
+    ----------
+    rf: np.ndarray
+        2D image or 3D stack of images of the same size
+    ftype: str
+        'poly' for the Kaiser filter of signal.resample_poly, 'fir' for the Hamming filter of signal.decimate
+    dtype: numpy dtype
+        float dtype of the filters and of the returned array
+    '''
+    (height, width) = np.shape(rf)[-2:]
+    fe_x = max(round(width/max_width), 1)
+    fe_y = max(round(height/max_height), 1)
+    rf = np.asarray(rf, dtype=dtype)
+    if fe_y > 1:
+        rf = np.matmul(_decimation_matrix(height, fe_y, ftype, np.dtype(dtype)), rf)
+    if fe_x > 1:
+        rf = np.matmul(rf, _decimation_matrix(width, fe_x, ftype, np.dtype(dtype)).T)
     return rf
 
 
 def regular_sample(rf, max_width=160, max_height=160):
     '''Reduce size array to approximately widthxheight size. Need to complete with shape_to function. '''
-    (height, width) = np.shape(rf)
+    (height, width) = np.shape(rf)[-2:]
     fe_x = round(width/max_width)
     fe_y = round(height/max_height)
-    rf = rf[:, range(0, width, fe_x)]
-    rf = rf[range(0, height, fe_y), :]
-    return rf
+    return rf[..., ::fe_y, ::fe_x]
+
+
+def preprocess_batch(frames, max_width=160, max_height=160, dtype=np.float32, out=None, antialias=False):
+    '''Sample and shape a batch of frames to the CNN input format in one pass.
+    Each frame goes through regular_sample and shape_to, and is written straight into
+    its slot of the output buffer.
+    Parameters
+    ----------
+    frames: 3D array or iterable of 2D arrays
+        stack of frames of the same size, or frames of mixed sizes
+    dtype: numpy dtype
+        dtype of the output buffer, ignored when out is given
+    out: 3D array
+        preallocated (N, max_height, max_width) buffer to fill, reused between calls
+    antialias: bool
+        sample with antialiased_sample instead of regular_sample
+        
+    Returns 3D contiguous array of shape (N, max_height, max_width)
+    '''
+    if not isinstance(frames, np.ndarray):
+        frames = [np.asarray(frame) for frame in frames]
+    shape = (len(frames), max_height, max_width)
+    if out is None:
+        out = np.empty(shape, dtype=dtype)
+    elif out.shape != shape:
+        raise ValueError(f"Output buffer has shape {out.shape}, expected {shape}")
+
+    sample = antialiased_sample if antialias else regular_sample
+    if isinstance(frames, np.ndarray) and frames.ndim == 3:
+        # same size frames: sample, crop and pad the whole stack at once
+        sampled = sample(frames, max_width, max_height)
+        _place_into(crop_from_array(sampled, max_width, max_height), out)
+    else:
+        for frame, slot in zip(frames, out):
+            sampled = sample(frame, max_width, max_height)
+            _place_into(crop_from_array(sampled, max_width, max_height), slot)
+    return out
     
     
-def random_sample(rf):
-    '''Supposed to reduce size array but it just creates a noisy image.'''
+def _grid_cells(size, n_cells):
+    '''Return the start and the size of n_cells contiguous cells covering an axis of length size.'''
+    bounds = (np.arange(n_cells + 1) * size) // n_cells
+    return bounds[:-1], np.diff(bounds)
 
-    import random
-    (height, width) = np.shape(rf)
-    aleatory_sample = np.ones((height, width))
-    for i in range(160):
-        for j in range(160):
-            x = random.randint(0, height-1)
-            y = random.randint(0, width-1)
-            aleatory_sample[(i, j)] = rf[(x, y)]
-    img = Image.fromarray(aleatory_sample)
-    img = img.convert("L")
-    return aleatory_sample
+
+def random_sample(rf, max_width=160, max_height=160, seed=None, mode='uniform'):
+    '''Reduce size array to exactly max_height x max_width by picking pixels at random.
+    Parameters
+    ----------
+    rf: np.ndarray
+        2D image, or stack of images of the same size (each one is sampled independently)
+    seed: int or np.random.Generator
+        seed or generator making the sampling reproducible
+    mode: str
+        'uniform' picks every output pixel anywhere in the image (noisy image),
+        'stratified' picks it anywhere in its own cell of a max_height x max_width grid,
+        'jittered' shifts every grid row and every grid column by a random offset inside its cell,
+        which keeps straight lines straight
+        
+    Returns np.ndarray of shape (..., max_height, max_width), with the dtype of rf
+    '''
+    rng = np.random.default_rng(seed)
+    rf = np.asarray(rf)
+    (height, width) = rf.shape[-2:]
+    batch_shape = rf.shape[:-2]
+    out_shape = batch_shape + (max_height, max_width)
+
+    if mode == 'uniform':
+        rows = rng.integers(0, height, out_shape)
+        columns = rng.integers(0, width, out_shape)
+    elif mode in ('stratified', 'jittered'):
+        row_starts, row_sizes = _grid_cells(height, max_height)
+        column_starts, column_sizes = _grid_cells(width, max_width)
+        row_starts, row_sizes = row_starts[:, np.newaxis], row_sizes[:, np.newaxis]
+        if mode == 'stratified':
+            row_draw, column_draw = out_shape, out_shape
+        else:
+            row_draw, column_draw = batch_shape + (max_height, 1), batch_shape + (1, max_width)
+        rows = row_starts + (rng.random(row_draw) * row_sizes).astype(np.intp)
+        columns = column_starts + (rng.random(column_draw) * column_sizes).astype(np.intp)
+        rows, columns = np.broadcast_arrays(rows, columns)
+    else:
+        raise ValueError(f"Unknown sampling mode {mode!r}, expected 'uniform', 'stratified' or 'jittered'")
+
+    flat_index = (rows * width + columns).reshape(batch_shape + (-1,))
+    flat_rf = rf.reshape(batch_shape + (height * width,))
+    return np.take_along_axis(flat_rf, flat_index, axis=-1).reshape(out_shape)
 
 
 def load_pkl_file(saving_path):
@@ -157,6 +248,7 @@ def load_pkl_file(saving_path):
 
 def disp_img_from_array(img_array):
     '''Display grayscale image from array. '''
+    from PIL import Image
     img = Image.fromarray(img_array)
     img = img.convert("L")
     
@@ -165,6 +257,7 @@ def disp_img_from_array(img_array):
     
 def save_img_from_array(rf, path_to_save):
     '''Save grayscale image from array. '''
+    from PIL import Image
     img = Image.fromarray(rf)
     img = img.convert("L")
 
@@ -177,12 +270,34 @@ def save_pkl_from_array(rf, path_to_save):
         pickle.dump(rf, pkl_file)
         
         
+def threshold_map(rf, threshold=0.5, dtype=np.uint8, out=None, strict=False):
+    '''Turn a map, or a batch of maps, into a binary image of 0 (black) and 255 (white) pixels.
+    Parameters
+    ----------
+    rf: np.ndarray
+        map(s) to threshold, of any shape
+    threshold: float
+        values at or above the threshold become white
+    dtype: numpy dtype
+        dtype of the returned array, ignored when out is given
+    out: np.ndarray
+        array of the same shape to write the result into, may be rf itself
+    strict: bool
+        only values strictly above the threshold become white
+        
+    Returns np.ndarray with pixel values of 0 and 255
+    '''
+    white = np.greater(rf, threshold) if strict else np.greater_equal(rf, threshold)
+    if out is None:
+        out = np.empty(white.shape, dtype=dtype)
+    np.multiply(white, 255, out=out, casting='unsafe')
+    return out
+
+
 def create_mask(rf):
-    '''Create a mask array to make it visible. Useful when masks are made of 0 and 1 values.'''
-    for i in range(np.shape(rf)[0]):
-        for j in range(np.shape(rf)[1]):
-            if rf[(i, j)] > 0:
-                rf[(i, j)] = 255
+    '''Create a mask array to make it visible. Useful when masks are made of 0 and 1 values.
+    Positive pixels become 255 in place, the others (0 or negative) are kept.'''
+    np.putmask(rf, rf > 0, 255)
     return rf
 
 
@@ -195,30 +310,129 @@ def make_predictions(us_img_array, model):
         
     Returns 2D array with pixel values between 0 and 1, the segmented image predicted
     '''
-    predictions = model.predict(np.reshape(us_img_array, (1, 160, 160))) 
-    return np.reshape(predictions, (160, 160)) # Restore predictions array to correct format
+    return next(iter_predictions([us_img_array], model, batch_size=1))
+
+
+def _run_model(model, batch):
+    '''Call the model directly on a batch, which avoids the per-call overhead of model.predict.'''
+    predictions = model(batch, training=False)
+    return np.reshape(np.asarray(predictions), (len(batch), 160, 160)) # Restore predictions array to correct format
+
+
+def iter_predictions(us_img_arrays, model, batch_size=16):
+    '''Generate the 2D arrays predicted by the CNN for many images, in their input order.
+    Images are grouped into micro-batches of batch_size images filled in a reused buffer,
+    and predictions are yielded as soon as their micro-batch has been run.
+    Parameters
+    ----------
+    us_img_arrays: 3D array, list or iterator of 2D arrays
+        ultrasound images of 160x160 pixels
+    batch_size: int
+        number of images given to the CNN in one call, lowered for shorter inputs
+        
+    Yields 2D arrays with pixel values between 0 and 1, the segmented images predicted
+    '''
+    if hasattr(us_img_arrays, '__len__'):
+        batch_size = max(1, min(batch_size, len(us_img_arrays)))
+    buffer = np.empty((batch_size, 160, 160), dtype=np.float32)
+    count = 0
+    for us_img_array in us_img_arrays:
+        buffer[count] = np.reshape(us_img_array, (160, 160))
+        count += 1
+        if count == batch_size:
+            yield from _run_model(model, buffer)
+            count = 0
+    if count:
+        yield from _run_model(model, buffer[:count])
+
+
+def make_batch_predictions(us_img_arrays, model, batch_size=16):
+    '''Generate the predictions of the CNN for many images.
+    See iter_predictions for the parameters.
+    
+    Returns 3D array of shape (N, 160, 160) with pixel values between 0 and 1
+    '''
+    predictions = list(iter_predictions(us_img_arrays, model, batch_size))
+    if not predictions:
+        return np.empty((0, 160, 160), dtype=np.float32)
+    return np.stack(predictions)
     
 
-def create_img_from_predictions(predicted_array, pixal_format=True):
+def _tile_origins(size, tile_size, stride):
+    '''Return the tile start positions covering an axis, the last tile being aligned on the border.'''
+    if size <= tile_size:
+        return [0]
+    origins = list(range(0, size - tile_size, stride))
+    origins.append(size - tile_size)
+    return origins
+
+
+def _tile_weights(tile_size, overlap):
+    '''Blending weights of a tile: 1 in the center, ramping down linearly over the overlap border.'''
+    ramp = np.ones(tile_size, dtype=np.float32)
+    if overlap > 0:
+        edge = np.arange(1, overlap + 1, dtype=np.float32) / (overlap + 1)
+        ramp[:overlap] = edge
+        ramp[tile_size-overlap:] = edge[::-1]
+    return np.outer(ramp, ramp)
+
+
+def predict_tiled(us_img_array, model, overlap=32, batch_size=16, tile_size=160):
+    '''Generate the prediction of the CNN at the native resolution of an image.
+    The image is cut into overlapping tile_size x tile_size tiles which are run through the CNN
+    in micro-batches (see iter_predictions), and the tile predictions are blended back with weights
+    decreasing towards the tile borders. Only batch_size tiles are held in memory at once.
+    Parameters
+    ----------
+    us_img_array: 2D array
+        ultrasound image of any size, smaller images are padded with black pixels on their bottom and right sides
+    overlap: int
+        number of pixels shared by neighbouring tiles, lower than tile_size/2
+    batch_size: int
+        number of tiles given to the CNN in one call
+        
+    Returns 2D array of the image shape with pixel values between 0 and 1, the segmented image predicted
+    '''
+    if not 0 <= overlap < tile_size // 2:
+        raise ValueError(f"Tile overlap must be between 0 and {tile_size//2 - 1}, got {overlap}")
+    (height, width) = np.shape(us_img_array)
+    # tiles need at least one full tile: the padding is added after the image, so that tiles only see
+    # the native image followed by black pixels
+    padded = np.pad(np.asarray(us_img_array), ((0, max(tile_size - height, 0)), (0, max(tile_size - width, 0))))
+    (padded_height, padded_width) = padded.shape
+
+    stride = tile_size - overlap
+    origins = [(y, x) for y in _tile_origins(padded_height, tile_size, stride)
+                      for x in _tile_origins(padded_width, tile_size, stride)]
+    tiles = (padded[y:y+tile_size, x:x+tile_size] for (y, x) in origins)
+
+    weights = _tile_weights(tile_size, overlap)
+    blended = np.zeros((padded_height, padded_width), dtype=np.float32)
+    weight_sum = np.zeros((padded_height, padded_width), dtype=np.float32)
+    for (y, x), tile_prediction in zip(origins, iter_predictions(tiles, model, batch_size)):
+        blended[y:y+tile_size, x:x+tile_size] += weights * tile_prediction
+        weight_sum[y:y+tile_size, x:x+tile_size] += weights
+    blended /= weight_sum
+
+    return blended[:height, :width]
+
+
+def create_img_from_predictions(predicted_array, pixal_format=True, threshold=0.5):
     '''Display the binary image following the predictions made by the CNN.
     Parameters
     ----------
     predicted_array: 2D array
-        the segmented image predicted with pixel values between 0 and 1
+        the segmented image predicted with pixel values between 0 and 1, or a batch of them
     pixal_format: bool
         choose if the segmented image is changed to Pixel format to display it in the UI
+    threshold: float
+        prediction value from which a pixel is classified as white
     Returns 2D array with pixel values of 0 and 255, the segmented image predicted
     '''
-    for i in range(160):
-        for j in range(160):
-            if predicted_array[(i, j)] < 0.5:
-                predicted_array[(i, j)] = 0 # black
-            else: 
-                predicted_array[(i, j)] = 255 # white
     if pixal_format == True:
-        return predicted_array.astype(np.uint8) 
+        return threshold_map(predicted_array, threshold)
     else:
-        return predicted_array
+        return threshold_map(predicted_array, threshold, out=predicted_array)
 
 def equa_hist(img_array):
     '''Increase contrast by histogram equalization method and display the original and the new histogram.'''
@@ -237,8 +451,50 @@ def equa_hist(img_array):
     return equa_img_array
 
 
+def equalization_lut(hist):
+    '''Build the 256-entry lookup table equalizing a 256-bin histogram.'''
+    cdf = hist.cumsum()
+    return ((255*cdf) / cdf[-1]).astype(np.uint8)
+
+
+def equalize_histogram(img_array, shared_histogram=False):
+    '''Increase contrast by histogram equalization, without displaying anything.
+    Parameters
+    ----------
+    img_array: np.ndarray, uint8 encoded
+        2D image, or 3D batch of images
+    shared_histogram: bool
+        for a batch, equalize every image with the histogram of the whole batch
+        instead of its own histogram
+        
+    Returns np.ndarray, uint8 encoded, with the same shape as img_array
+    '''
+    img_array = np.asarray(img_array)
+    if img_array.dtype != np.uint8:
+        raise ValueError(f"Histogram equalization expects uint8 images, got {img_array.dtype}")
+
+    if img_array.ndim == 2 or shared_histogram:
+        lut = equalization_lut(np.bincount(img_array.ravel(), minlength=256))
+        return lut[img_array]
+
+    # one histogram per image: offset each image's values into its own 256 bins
+    n_images = img_array.shape[0]
+    offsets = 256*np.arange(n_images).reshape((n_images,) + (1,)*(img_array.ndim-1))
+    binned = img_array + offsets
+    hists = np.bincount(binned.ravel(), minlength=256*n_images).reshape(n_images, 256)
+    luts = np.apply_along_axis(equalization_lut, 1, hists)
+    return luts.ravel()[binned]
+
+
+def represent_equalization(img_array, equa_img_array):
+    '''Display the histograms of an image before and after equalization.'''
+    represent_histogram(img_array, "Before equalization")
+    represent_histogram(equa_img_array, "After equalization")
+
+
 def represent_histogram(img_array, hist_legend):
     '''Display a histogram using an image array.'''
+    import matplotlib.pyplot as plt
     hist, bins = np.histogram(img_array, 256, [0, 256])
     hist = np.append(hist, 0)
     plt.plot(bins, hist, label=hist_legend)
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""Segmentation metrics computed with numpy from predictions that were already made.
+"""
+
+import numpy as np
+
+
+SCORE_NAMES = ("iou", "dice", "precision", "recall", "accuracy", "mean_iou")
+
+
+def confusion_counts(predicted_array, mask_array, threshold=0.5):
+    '''Count true/false positives/negatives of a predicted segmentation against a reference mask.
+    Parameters
+    ----------
+    predicted_array: np.ndarray
+        predictions between 0 and 1, or a segmented image of 0 and 255, of shape (H, W) or (N, H, W)
+    mask_array: np.ndarray
+        reference mask of the same shape, any non-zero pixel being part of the lesion
+    threshold: float
+        prediction value from which a pixel is classified as lesion
+
+    Returns int64 array of shape (..., 4): true positives, false positives, false negatives, true negatives
+    '''
+    predicted = np.asarray(predicted_array) >= threshold
+    reference = np.asarray(mask_array) > 0
+    if predicted.shape != reference.shape:
+        raise ValueError(f"Prediction shape {predicted.shape} does not match mask shape {reference.shape}")
+    axes = (-2, -1)
+    true_positives = np.count_nonzero(predicted & reference, axis=axes)
+    predicted_positives = np.count_nonzero(predicted, axis=axes)
+    reference_positives = np.count_nonzero(reference, axis=axes)
+    pixels = predicted.shape[-2] * predicted.shape[-1]
+    false_positives = predicted_positives - true_positives
+    false_negatives = reference_positives - true_positives
+    true_negatives = pixels - true_positives - false_positives - false_negatives
+    return np.stack([true_positives, false_positives, false_negatives, true_negatives], axis=-1).astype(np.int64)
+
+
+def _ratio(numerator, denominator):
+    '''Divide counts, an empty denominator meaning a perfect score (nothing to find, nothing found).'''
+    numerator = np.asarray(numerator, dtype=np.float64)
+    denominator = np.asarray(denominator, dtype=np.float64)
+    return np.divide(numerator, denominator, out=np.ones(np.broadcast(numerator, denominator).shape),
+                     where=denominator > 0)
+
+
+def scores_from_counts(counts):
+    '''Compute the segmentation scores from confusion counts.
+    Parameters
+    ----------
+    counts: np.ndarray
+        array of shape (..., 4) returned by confusion_counts
+
+    Returns dict of float arrays of shape (...): iou, dice, precision, recall, accuracy and mean_iou,
+    the IoU averaged over the lesion and background classes as tf.keras.metrics.MeanIoU(num_classes=2)
+    '''
+    counts = np.asarray(counts)
+    tp, fp, fn, tn = (counts[..., i] for i in range(4))
+    iou = _ratio(tp, tp + fp + fn)
+    background_iou = _ratio(tn, tn + fp + fn)
+    return {
+        "iou": iou,
+        "dice": _ratio(2*tp, 2*tp + fp + fn),
+        "precision": _ratio(tp, tp + fp),
+        "recall": _ratio(tp, tp + fn),
+        "accuracy": _ratio(tp + tn, tp + fp + fn + tn),
+        "mean_iou": (iou + background_iou) / 2,
+    }
+
+
+def segmentation_scores(predicted_array, mask_array, threshold=0.5):
+    '''Compute the segmentation scores of one prediction, or of each prediction of a batch.
+    See confusion_counts for the parameters and scores_from_counts for the result.'''
+    return scores_from_counts(confusion_counts(predicted_array, mask_array, threshold))
+
+
+class StreamingMetrics:
+    '''Accumulate segmentation scores over a dataset, one image or one batch at a time.
+
+    Scores are reported both over all the pixels of the dataset (micro average) and as the mean
+    of the per-image scores (macro average).
+    '''
+
+    def __init__(self, threshold=0.5):
+        self.threshold = threshold
+        self.counts = np.zeros(4, dtype=np.int64)
+        self.image_count = 0
+        self._score_sums = dict.fromkeys(SCORE_NAMES, 0.0)
+
+    def update(self, predicted_array, mask_array):
+        '''Add a prediction (H, W) or a batch of predictions (N, H, W) and their reference masks.
+
+        Returns dict of the scores of the added images
+        '''
+        counts = confusion_counts(predicted_array, mask_array, self.threshold).reshape(-1, 4)
+        scores = scores_from_counts(counts)
+        self.counts += counts.sum(axis=0)
+        self.image_count += len(counts)
+        for name in SCORE_NAMES:
+            self._score_sums[name] += float(scores[name].sum())
+        return scores
+
+    def result(self):
+        '''Return the scores accumulated so far.
+
+        Returns dict with the micro averaged scores, the macro averaged scores (prefixed with "mean_image_")
+        and the number of images
+        '''
+        result = {name: float(value) for name, value in scores_from_counts(self.counts).items()}
+        for name in SCORE_NAMES:
+            result["mean_image_" + name] = self._score_sums[name] / self.image_count if self.image_count else float("nan")
+        result["images"] = self.image_count
+        return result
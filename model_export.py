@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""Export segmentation models to TFLite flatbuffers for fast CPU inference, and check their accuracy.
+
+Usage: python model_export.py models/UNET_a_160.h5 models/UNET_a_160_int8.tflite --quantization int8
+       --calibration-dir oral_dataset/training/us --report-dir oral_dataset/validation/us
+"""
+
+import argparse
+import os
+import threading
+
+import numpy as np
+
+from image_processing import make_batch_predictions, threshold_map
+from metrics import StreamingMetrics
+from model_registry import get_tf, load_keras_model
+
+
+QUANTIZATIONS = (None, "float16", "int8")
+
+
+def _load_interpreter_class():
+    '''Return the TFLite interpreter class, from the light tflite_runtime package when it is installed.'''
+    try:
+        from tflite_runtime.interpreter import Interpreter
+    except ImportError:
+        Interpreter = get_tf().lite.Interpreter
+    return Interpreter
+
+
+class TFLiteModel:
+    '''TFLite flatbuffer callable like a Keras model: model(batch, training=False) returns the predictions.
+
+    The interpreter input is resized when the batch size changes, calls are serialised by a lock
+    because an interpreter cannot be shared by several threads at once.
+    '''
+
+    def __init__(self, model_path, num_threads=None):
+        self.model_path = model_path
+        self.nbytes = os.path.getsize(model_path)
+        self._interpreter = _load_interpreter_class()(model_path=model_path, num_threads=num_threads)
+        self._interpreter.allocate_tensors()
+        self._input = self._interpreter.get_input_details()[0]
+        self._output_index = self._interpreter.get_output_details()[0]["index"]
+        self._batch_size = int(self._input["shape"][0])
+        self._lock = threading.Lock()
+
+    def __call__(self, batch, training=False):
+        batch = np.asarray(batch)
+        input_shape = tuple(self._input["shape"][1:])
+        batch = np.reshape(batch, (-1,) + input_shape).astype(self._input["dtype"], copy=False)
+        with self._lock:
+            if len(batch) != self._batch_size:
+                self._interpreter.resize_tensor_input(self._input["index"], (len(batch),) + input_shape)
+                self._interpreter.allocate_tensors()
+                self._batch_size = len(batch)
+            self._interpreter.set_tensor(self._input["index"], batch)
+            self._interpreter.invoke()
+            return self._interpreter.get_tensor(self._output_index).copy()
+
+
+def _calibration_dataset(calibration_dir, calibration_samples):
+    '''Yield calibration inputs for int8 quantization from a directory of ultrasound images.'''
+    from forward import list_input_images, load_and_prepare
+
+    paths = list_input_images(calibration_dir)[:calibration_samples]
+    if not paths:
+        raise ValueError(f"No calibration image found in {calibration_dir}")
+    for path in paths:
+        yield [np.reshape(load_and_prepare(path), (1, 160, 160))]
+
+
+def export_tflite(model_path, tflite_path, quantization=None, calibration_dir=None, calibration_samples=100):
+    '''Convert a saved Keras model to a TFLite flatbuffer.
+    Parameters
+    ----------
+    model_path: str
+        path of the saved Keras model (.h5)
+    tflite_path: str
+        path of the .tflite file to write
+    quantization: str
+        None for float32, "float16" for float16 weights, "int8" for weights and activations
+        quantized after calibration
+    calibration_dir: str
+        directory of ultrasound images used to calibrate the int8 quantization
+    calibration_samples: int
+        maximum number of calibration images
+
+    Returns int, size of the written file in bytes
+    '''
+    if quantization not in QUANTIZATIONS:
+        raise ValueError(f"Unknown quantization {quantization!r}, expected one of {QUANTIZATIONS}")
+    if quantization == "int8" and calibration_dir is None:
+        raise ValueError("int8 quantization needs a calibration directory")
+
+    tf = get_tf()
+    converter = tf.lite.TFLiteConverter.from_keras_model(load_keras_model(model_path))
+    if quantization is not None:
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantization == "float16":
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == "int8":
+        converter.representative_dataset = lambda: _calibration_dataset(calibration_dir, calibration_samples)
+
+    flatbuffer = converter.convert()
+    with open(tflite_path, "wb") as f:
+        f.write(flatbuffer)
+    return len(flatbuffer)
+
+
+def accuracy_delta_report(model_path, tflite_path, image_dir, mask_dir=None, batch_size=16):
+    '''Compare the predictions of a TFLite export with those of its Keras model.
+    Parameters
+    ----------
+    model_path: str
+        path of the saved Keras model
+    tflite_path: str
+        path of the exported .tflite file
+    image_dir: str
+        directory of ultrasound images to segment with both models
+    mask_dir: str
+        directory of reference masks named like the images, to compare the scores of both models
+
+    Returns dict with the largest and mean absolute difference between predictions, the fraction of
+    mask pixels that changed, the IoU between the Keras and TFLite masks and, with mask_dir, the scores
+    of both models against the reference masks
+    '''
+    from forward import list_input_images, load_and_prepare
+
+    paths = list_input_images(image_dir)
+    if not paths:
+        raise ValueError(f"No image found in {image_dir}")
+    keras_model = load_keras_model(model_path)
+    tflite_model = TFLiteModel(tflite_path)
+    agreement = StreamingMetrics()
+    reference_scores = {"keras": StreamingMetrics(), "tflite": StreamingMetrics()} if mask_dir else None
+    max_difference, difference_sum, changed_pixels, pixels = 0.0, 0.0, 0, 0
+
+    for start in range(0, len(paths), batch_size):
+        batch_paths = paths[start:start+batch_size]
+        images = np.stack([load_and_prepare(path) for path in batch_paths])
+        keras_predictions = make_batch_predictions(images, keras_model, batch_size)
+        tflite_predictions = make_batch_predictions(images, tflite_model, batch_size)
+
+        difference = np.abs(keras_predictions - tflite_predictions)
+        max_difference = max(max_difference, float(difference.max()))
+        difference_sum += float(difference.sum())
+        changed_pixels += int(np.count_nonzero(threshold_map(keras_predictions) != threshold_map(tflite_predictions)))
+        pixels += difference.size
+        agreement.update(tflite_predictions, keras_predictions >= 0.5)
+        if reference_scores is not None:
+            masks = np.stack([load_and_prepare(os.path.join(mask_dir, os.path.basename(path))) for path in batch_paths])
+            reference_scores["keras"].update(keras_predictions, masks)
+            reference_scores["tflite"].update(tflite_predictions, masks)
+
+    report = {
+        "images": len(paths),
+        "max_abs_difference": max_difference,
+        "mean_abs_difference": difference_sum / pixels,
+        "changed_mask_pixels": changed_pixels / pixels,
+        "keras_tflite_mask_iou": agreement.result()["iou"],
+    }
+    if reference_scores is not None:
+        for backend, streaming_metrics in reference_scores.items():
+            report[backend + "_scores"] = streaming_metrics.result()
+        report["iou_delta"] = report["tflite_scores"]["iou"] - report["keras_scores"]["iou"]
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export a Keras segmentation model to TFLite.")
+    parser.add_argument("model_path", help="saved Keras model (.h5)")
+    parser.add_argument("tflite_path", help="TFLite file to write")
+    parser.add_argument("--quantization", choices=["float16", "int8"], help="post-training quantization")
+    parser.add_argument("--calibration-dir", help="ultrasound images calibrating the int8 quantization")
+    parser.add_argument("--calibration-samples", type=int, default=100, help="maximum number of calibration images")
+    parser.add_argument("--report-dir", help="ultrasound images on which to compare the export with the Keras model")
+    parser.add_argument("--mask-dir", help="reference masks of the report images, named like them")
+    args = parser.parse_args()
+
+    size = export_tflite(args.model_path, args.tflite_path, args.quantization, args.calibration_dir, args.calibration_samples)
+    print(f"{args.tflite_path} written ({size/1e6:.1f} MB)")
+    if args.report_dir:
+        report = accuracy_delta_report(args.model_path, args.tflite_path, args.report_dir, args.mask_dir)
+        for name, value in report.items():
+            if isinstance(value, dict):
+                value = ", ".join(f"{key}: {score:.4f}" for key, score in value.items() if key != "images")
+            print(f"{name}: {value}")
+
+
+if __name__ == '__main__':
+    main()
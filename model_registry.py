@@ -0,0 +1,153 @@
+"""
+Process-wide cache of loaded segmentation models.
+Every window and script asking for the same model file shares one loaded model.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+_tf_module = None
+
+
+def get_tf():
+    """Lazy-load TensorFlow so importing this module stays cheap. Shared by the modules loading models."""
+    global _tf_module
+    if _tf_module is None:
+        import tensorflow as tf
+        _tf_module = tf
+    return _tf_module
+
+
+def load_keras_model(model_path):
+    """Load a saved Keras model for inference."""
+    return get_tf().keras.models.load_model(model_path, compile=False)
+
+
+def load_model(model_path):
+    """
+    Load a model for inference, with the backend matching its file.
+
+    .tflite files run on the TFLite interpreter, Keras models are wrapped in a traced
+    and warmed-up tf.function (see compiled_inference.CompiledModel).
+    """
+    if model_path.lower().endswith(".tflite"):
+        from model_export import TFLiteModel
+        return TFLiteModel(model_path)
+    from compiled_inference import CompiledModel
+    return CompiledModel(load_keras_model(model_path))
+
+
+def estimate_model_bytes(model) -> int:
+    """Return the memory held by the weights of a loaded model, for tf.keras 2 and Keras 3 variables."""
+    if hasattr(model, "nbytes"):
+        return model.nbytes
+    # tf.keras 2 variables have a TensorShape and a tf.DType, Keras 3 variables a tuple and a dtype name
+    return sum(int(np.prod(tuple(weight.shape))) * np.dtype(getattr(weight.dtype, "as_numpy_dtype", weight.dtype)).itemsize
+               for weight in model.weights)
+
+
+class ModelRegistry:
+    """
+    LRU cache of loaded models keyed by model file.
+
+    An entry is reused while the file keeps the same modification time and size, and is reloaded
+    as soon as the file changes on disk. Least recently used models are evicted when the registry
+    holds more than max_models models or more than memory_budget bytes of weights.
+    """
+
+    def __init__(self, max_models=4, memory_budget=None, loader=load_model, sizer=estimate_model_bytes):
+        """
+        Initialize an empty registry.
+
+        Args:
+            max_models: Maximum number of models kept loaded
+            memory_budget: Maximum total weight bytes kept loaded (default: no limit)
+            loader: Function loading a model from its path
+            sizer: Function returning the memory held by a loaded model
+        """
+        self.max_models = max_models
+        self.memory_budget = memory_budget
+        self._loader = loader
+        self._sizer = sizer
+        self._entries = OrderedDict()  # absolute path -> (file signature, model, bytes or None if not measured)
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, model_path) -> bool:
+        return os.path.abspath(model_path) in self._entries
+
+    @staticmethod
+    def _signature(path) -> tuple:
+        stat = os.stat(path)
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def get(self, model_path):
+        """
+        Return the loaded model for a file, loading it only if it is not cached or changed on disk.
+
+        Args:
+            model_path: Path of the saved model
+
+        Returns:
+            The loaded model
+
+        Raises:
+            OSError: If the model file does not exist
+        """
+        path = os.path.abspath(model_path)
+        signature = self._signature(path)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[0] == signature:
+                self._entries.move_to_end(path)
+                return entry[1]
+
+            self._entries.pop(path, None)
+            model = self._loader(path)
+            # models are only measured when a memory budget has to be enforced
+            size = self._sizer(model) if self.memory_budget is not None else None
+            self._entries[path] = (signature, model, size)
+            self._evict(keep=path)
+            return model
+
+    def invalidate(self, model_path=None) -> None:
+        """Drop one cached model, or all of them."""
+        with self._lock:
+            if model_path is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(os.path.abspath(model_path), None)
+
+    def memory_used(self) -> int:
+        """Return the weight bytes held by the cached models."""
+        with self._lock:
+            return sum(self._sizer(model) if size is None else size for _, model, size in self._entries.values())
+
+    def _evict(self, keep) -> None:
+        """Drop least recently used models until the limits are met, never dropping keep."""
+        while len(self._entries) > 1 and (
+                len(self._entries) > self.max_models
+                or (self.memory_budget is not None and self.memory_used() > self.memory_budget)):
+            oldest = next(iter(self._entries))
+            if oldest == keep:
+                break
+            del self._entries[oldest]
+
+
+_registry = ModelRegistry()
+
+
+def get_registry() -> ModelRegistry:
+    """Return the registry shared by the whole process."""
+    return _registry
+
+
+def get_model(model_path):
+    """Return the shared loaded model for a file (see ModelRegistry.get)."""
+    return _registry.get(model_path)
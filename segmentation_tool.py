@@ -4,8 +4,6 @@ Created on Sun May 30 01:27:18 2021
 
 @author: flore
 """
-from scipy import signal
-from PIL import Image 
 import numpy as np
 import sys, os
 from PyQt5.QtWidgets import *
@@ -13,18 +11,7 @@ from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 from image_processing import *
 from directory_segmentation import DirectorySegmentation
-
-
-_tf_module = None
-
-
-def _get_tf():
-    """Lazy-load TensorFlow so the UI starts faster."""
-    global _tf_module
-    if _tf_module is None:
-        import tensorflow as tf
-        _tf_module = tf
-    return _tf_module
+from model_registry import get_model
 
 
 class AppConfig:
@@ -41,6 +28,8 @@ class AppConfig:
     
     CROP_TOOL_WIDTH = 1280
     CROP_TOOL_HEIGHT = 800
+    
+    SEGMENTATION_LATENCY_BUDGET_MS = 200
 
 
 class SegTool(QMainWindow):
@@ -122,6 +111,9 @@ class SegTool(QMainWindow):
         open_directory_button.setMinimumWidth(AppConfig.BUTTON_WIDTH_SMALL)
         open_directory_button.clicked.connect(self.chooseDirectory)
 
+        self.tiled_checkbox = QCheckBox("Segment at full resolution (tiled)")
+        self.tiled_checkbox.setMinimumWidth(AppConfig.BUTTON_WIDTH_SMALL)
+
         parametres_layout = QGridLayout(parametre_box)
         
         parametres_layout.addWidget(choose_model, 0, 0)
@@ -135,6 +127,7 @@ class SegTool(QMainWindow):
 
         parametres_layout.addWidget(browse_mask_image, 2, 1)
         parametres_layout.addWidget(open_directory_button, 3, 0, 1, 2)
+        parametres_layout.addWidget(self.tiled_checkbox, 3, 2)
     
     # IMAGE DISPLAY FRAME
         # US IMAGE FRAME
@@ -230,7 +223,7 @@ class SegTool(QMainWindow):
 
 
     def addModelFile(self):
-        model_path, _ = QFileDialog.getOpenFileName(self, "Select segmentation model", "", "Model Files (*.h5 *.hdf5);;All Files (*)")
+        model_path, _ = QFileDialog.getOpenFileName(self, "Select segmentation model", "", "Model Files (*.h5 *.hdf5 *.tflite);;All Files (*)")
         if not model_path:
             return
 
@@ -255,7 +248,7 @@ class SegTool(QMainWindow):
         
         
     def contrastImage(self):
-        self.contrast_image_array = equa_hist(self.us_img_array).astype(np.uint8) 
+        self.contrast_image_array = equalize_histogram(self.us_img_array)
         self.contrast_image = QImage(self.contrast_image_array, self.contrast_image_array.shape[1], self.contrast_image_array.shape[0],  
                                      QImage.Format_Grayscale8)
         self.contrasted_us_img_view.setPixmap(QPixmap(self.contrast_image))
@@ -293,16 +286,32 @@ class SegTool(QMainWindow):
 
 
     def runSegmentation(self):
+        tiled = self.tiled_checkbox.isChecked()
         
         if self.contrast_activated == False:
-            self.us_img_array = resize_and_sample(self.us_img_array)
-            self.seg_img_array = make_prediction(self.us_img_array, self.selected_model)
+            if not tiled:
+                self.us_img_array = resize_and_sample(self.us_img_array)
+            self.seg_img_array = make_prediction(self.us_img_array, self.selected_model, tiled)
         else:
-            self.contrast_image_array = resize_and_sample(self.contrast_image_array)
-            self.seg_img_array = make_prediction(self.contrast_image_array, self.selected_model)
+            if not tiled:
+                self.contrast_image_array = resize_and_sample(self.contrast_image_array)
+            self.seg_img_array = make_prediction(self.contrast_image_array, self.selected_model, tiled)
             
-        q_seg_img = QImage(self.seg_img_array, self.seg_img_array.shape[0], self.seg_img_array.shape[1], QImage.Format_Grayscale8)
+        q_seg_img = QImage(self.seg_img_array, self.seg_img_array.shape[1], self.seg_img_array.shape[0], self.seg_img_array.shape[1], 
+                           QImage.Format_Grayscale8)
         self.seg_img_view.setPixmap(QPixmap(q_seg_img))
+        self.showLatency()
+        
+        
+    def showLatency(self):
+        loaded_model = get_model(self.selected_model)
+        if not hasattr(loaded_model, "latency_stats"):
+            return
+        stats = loaded_model.latency_stats()
+        message = "Model latency over {} calls: p50 {:.0f} ms, p99 {:.0f} ms".format(stats["calls"], stats["p50"], stats["p99"])
+        if stats["p99"] > AppConfig.SEGMENTATION_LATENCY_BUDGET_MS:
+            message += " (over the {} ms budget)".format(AppConfig.SEGMENTATION_LATENCY_BUDGET_MS)
+        self.statusBar().showMessage(message)
         
         
     def saveSegmentation(self):
@@ -321,6 +330,7 @@ class cropTool(QDialog):
         self.setFixedSize(AppConfig.CROP_TOOL_WIDTH, AppConfig.CROP_TOOL_HEIGHT)
 
         image_to_crop_view = QLabel()
+        from PIL import Image
         self.image_to_crop = Image.fromarray(us_img_array)
         self.q_image_to_crop = QPixmap(q_us_img)
         
@@ -405,6 +415,7 @@ def prepare_image(img_array):
     
     Returns 2D numpy array, uint8 encoded
     '''
+    from PIL import Image
     img_array = Image.open(img_array)
     img_array = img_array.convert("L")
     
@@ -437,15 +448,31 @@ def save_image(seg_img_array, seg_filename):
     
     Returns None
     '''
+    from PIL import Image
     seg_img = Image.fromarray(seg_img_array)
     seg_img = seg_img.convert("L")
     seg_img.save(seg_filename)
         
 
-def make_prediction(sized_array, model_path="models/UNET_a_160.h5"): # keep the first combo box item as default value
-    tf = _get_tf()
-    loaded_model = tf.keras.models.load_model(model_path, compile=False) # load model
-    seg_img_array = create_img_from_predictions(make_predictions(sized_array, loaded_model)) # perform forward prediction
+def make_prediction(sized_array, model_path="models/UNET_a_160.h5", tiled=False): # keep the first combo box item as default value
+    '''Segment an image with a saved model.
+    Parameters
+    ----------
+    sized_array: 2D numpy array
+        image to segment, already resized to 160x160 unless tiled is True
+    model_path: str
+        path of the saved model
+    tiled: bool
+        segment the image at its native resolution with overlapping 160x160 tiles
+    
+    Returns 2D numpy array, uint8 encoded, the segmented image
+    '''
+    loaded_model = get_model(model_path) # load model once, shared by every window
+    if tiled:
+        predictions = predict_tiled(sized_array, loaded_model)
+    else:
+        predictions = make_predictions(sized_array, loaded_model)
+    seg_img_array = create_img_from_predictions(predictions) # perform forward prediction
 
     return seg_img_array
 
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""Measure the time-to-first-window of segmentation_tool.main with an offscreen Qt platform.
+
+Each run starts a fresh interpreter, so imports are paid every time as on a sonographer's workstation.
+Usage: python startup_benchmark.py [--runs 5] [--output startup_times.jsonl]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+# Runs in the child process: wraps SegTool.showMaximized to report the timings once the window is painted.
+_PROBE = '''
+import sys, time
+start = time.perf_counter()
+import segmentation_tool
+from PyQt5.QtWidgets import QApplication
+imported = time.perf_counter()
+show = segmentation_tool.SegTool.showMaximized
+def report_first_window(window):
+    show(window)
+    QApplication.processEvents()
+    print("{:.6f} {:.6f}".format(imported - start, time.perf_counter() - start), flush=True)
+    sys.exit(0)
+segmentation_tool.SegTool.showMaximized = report_first_window
+segmentation_tool.main()
+'''
+
+
+def measure_startup():
+    '''Start segmentation_tool in a new process and return its startup timings in seconds.
+
+    Returns dict with the import time, the time to first window from the first import,
+    and the wall time from process launch to first window (interpreter start included)
+    '''
+    env = dict(os.environ, QT_QPA_PLATFORM="offscreen")
+    launched = time.perf_counter()
+    result = subprocess.run([sys.executable, "-c", _PROBE], cwd=os.path.dirname(os.path.abspath(__file__)),
+                            env=env, capture_output=True, text=True)
+    wall = time.perf_counter() - launched
+    if result.returncode != 0:
+        raise RuntimeError(f"segmentation_tool failed to start:\n{result.stderr}")
+    import_time, first_window = (float(value) for value in result.stdout.split()[-2:])
+    return {"import": import_time, "first_window": first_window, "wall": wall}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time-to-first-window benchmark of segmentation_tool.")
+    parser.add_argument("--runs", type=int, default=5, help="number of cold starts to measure")
+    parser.add_argument("--output", help="JSONL file to append the results to")
+    args = parser.parse_args()
+
+    runs = [measure_startup() for _ in range(args.runs)]
+    summary = {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+    for key, value in summary.items():
+        print(f"{key:>12}: {value*1000:8.1f} ms (median of {args.runs})")
+
+    if args.output:
+        record = {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": sys.version.split()[0],
+                  "runs": runs, "median": summary}
+        with open(args.output, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record) + "\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""Check the vectorized functions of image_processing against the former loops.
+
+Usage: python -m pytest test_image_processing.py
+"""
+
+import numpy as np
+import pytest
+
+from image_processing import add_pixels, create_mask, crop_from_array, predict_tiled, shape_to
+
+
+def reference_crop_from_array(rf, max_width, max_height):
+    '''Former crop_from_array, removing one line/column at a time.'''
+    (height, width) = np.shape(rf)
+    high_cut = True
+    while width > max_width or height > max_height:
+        if width > max_width and height > max_height:
+            if high_cut == True:
+                rf = np.delete(rf, 0, axis=0)
+                rf = np.delete(rf, 0, axis=1)
+                high_cut = False
+            else:
+                rf = np.delete(rf, height-1, axis=0)
+                rf = np.delete(rf, width-1, axis=1)
+                high_cut = True
+        elif width > max_width and height <= max_height:
+            if high_cut == True:
+                rf = np.delete(rf, 0, axis=1)
+                high_cut = False
+            else:
+                rf = np.delete(rf, width-1, axis=1)
+                high_cut = True
+        elif width <= max_width and height > max_height:
+            if high_cut == True:
+                rf = np.delete(rf, 0, axis=0)
+                high_cut = False
+            else:
+                rf = np.delete(rf, height-1, axis=0)
+                high_cut = True
+        (height, width) = np.shape(rf)
+
+    return rf
+
+
+def reference_add_pixels(rf, max_width, max_height):
+    '''Former add_pixels, inserting one black line/column at a time.'''
+    (height, width) = np.shape(rf)
+    high_add = True
+    while width < max_width or height < max_height:
+        if width < max_width and height < max_height:
+            if high_add == True:
+                rf = np.insert(rf, 0, 0, axis=0)
+                rf = np.insert(rf, 0, 0, axis=1)
+                high_add = False
+            else:
+                rf = np.insert(rf, height-1, 0, axis=0)
+                rf = np.insert(rf, width-1, 0, axis=1)
+                high_add = True
+        elif width < max_width and height >= max_height:
+            if high_add == True:
+                rf = np.insert(rf, 0, 0, axis=1)
+                high_add = False
+            else:
+                rf = np.insert(rf, width-1, 0, axis=1)
+                high_add = True
+        elif width >= max_width and height < max_height:
+            if high_add == True:
+                rf = np.insert(rf, 0, 0, axis=0)
+                high_add = False
+            else:
+                rf = np.insert(rf, height-1, 0, axis=0)
+                high_add = True
+        (height, width) = np.shape(rf)
+
+    return rf
+
+
+def reference_shape_to(rf, max_width=160, max_height=160):
+    '''Former shape_to.'''
+    (height, width) = rf.shape
+    if height < max_height and width < max_width:
+        rf = reference_add_pixels(rf, max_width, max_height)
+    elif height > max_height and width > max_width:
+        rf = reference_crop_from_array(rf, max_width, max_height)
+    else:
+        rf = reference_add_pixels(rf, max_width, max_height)
+        rf = reference_crop_from_array(rf, max_width, max_height)
+
+    return rf
+
+
+def reference_create_mask(rf):
+    '''Former create_mask, thresholding pixel by pixel.'''
+    for i in range(np.shape(rf)[0]):
+        for j in range(np.shape(rf)[1]):
+            if rf[(i, j)] > 0:
+                rf[(i, j)] = 255
+    return rf
+
+
+def random_cases(n_cases, seed):
+    '''Yield random images of random shapes and dtypes, with random target shapes around them.'''
+    rng = np.random.default_rng(seed)
+    dtypes = (np.uint8, np.int16, np.float32, np.float64)
+    for _ in range(n_cases):
+        height, width = rng.integers(2, 60, size=2)
+        max_height, max_width = rng.integers(2, 60, size=2)
+        dtype = dtypes[rng.integers(len(dtypes))]
+        rf = (rng.uniform(1, 255, (height, width))).astype(dtype)
+        yield rf, int(max_width), int(max_height)
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_crop_from_array_matches_reference(seed):
+    for rf, max_width, max_height in random_cases(100, seed):
+        expected = reference_crop_from_array(rf, max_width, max_height)
+        result = crop_from_array(rf, max_width, max_height)
+        assert result.dtype == expected.dtype
+        np.testing.assert_array_equal(result, expected)
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_add_pixels_matches_reference(seed):
+    for rf, max_width, max_height in random_cases(100, seed):
+        expected = reference_add_pixels(rf, max_width, max_height)
+        result = add_pixels(rf, max_width, max_height)
+        assert result.dtype == expected.dtype
+        np.testing.assert_array_equal(result, expected)
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_shape_to_matches_reference(seed):
+    for rf, max_width, max_height in random_cases(100, seed):
+        expected = reference_shape_to(rf, max_width, max_height)
+        result = shape_to(rf, max_width, max_height)
+        assert result.shape == (max_height, max_width)
+        assert result.dtype == expected.dtype
+        np.testing.assert_array_equal(result, expected)
+
+
+def test_shape_to_default_size():
+    rf = np.random.default_rng(0).uniform(0, 255, (413, 97))
+    np.testing.assert_array_equal(shape_to(rf), reference_shape_to(rf))
+
+
+@pytest.mark.parametrize("dtype", (np.int16, np.float32, np.float64))
+def test_create_mask_matches_reference(dtype):
+    # 0 and negative values are on the boundary: they are kept, not set to 0
+    rf = np.array([[-3, -0.5, 0, 0.25], [0.5, 1, 2, 0]]).astype(dtype)
+    expected = reference_create_mask(rf.copy())
+    result = create_mask(rf)
+    assert result is rf
+    assert result.dtype == expected.dtype
+    np.testing.assert_array_equal(result, expected)
+
+
+class RecordingModel:
+    '''Model returning its input tiles, divided by 255, and recording them.'''
+
+    def __init__(self):
+        self.tiles = []
+
+    def __call__(self, batch, training=False):
+        self.tiles.extend(np.array(batch))
+        return batch / 255
+
+
+@pytest.mark.parametrize("shape", [(100, 233), (417, 97), (160, 301), (59, 61)])
+def test_predict_tiled_sees_the_native_image(shape):
+    # sizes which are not a multiple of the tile stride, some smaller than a tile
+    img = np.random.default_rng(0).uniform(1, 255, shape).astype(np.float32)
+    model = RecordingModel()
+    prediction = predict_tiled(img, model, overlap=32, batch_size=4)
+
+    assert prediction.shape == img.shape
+    np.testing.assert_allclose(prediction, img / 255, rtol=1e-5)
+    # every tile is a window of the image padded with black pixels after its last line and column only
+    padded = np.pad(img, ((0, max(160 - shape[0], 0)), (0, max(160 - shape[1], 0))))
+    windows = np.lib.stride_tricks.sliding_window_view(padded, (160, 160))
+    for tile in model.tiles:
+        assert (windows == tile).all(axis=(2, 3)).any()
@@ -0,0 +1,407 @@
+# -*- coding: utf-8 -*-
+"""Keras callbacks for long training sessions: background checkpointing and resume, early stopping
+and throughput telemetry.
+"""
+
+import csv
+import json
+import os
+import sys
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tensorflow as tf
+
+
+MANIFEST_FILE = "checkpoints.json"
+CHECKPOINT_PATTERN = "epoch_{:05d}.npz"
+
+
+def _optimizer_variables(optimizer):
+    '''Return the variables of an optimizer (iteration counter and slots), for old and new Keras optimizers.'''
+    variables = optimizer.variables
+    return list(variables() if callable(variables) else variables)
+
+
+def read_checkpoint_manifest(directory):
+    '''Read the list of checkpoints of a directory.
+
+    Returns dict with "checkpoints", the entries of the checkpoints kept in epoch order, "best",
+    the entry of the best checkpoint or None, and "monitor", the metric choosing the best checkpoint
+    '''
+    path = os.path.join(directory, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return {"checkpoints": [], "best": None, "monitor": None}
+    with open(path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    manifest.setdefault("monitor", None)
+    return manifest
+
+
+def _write_manifest(directory, manifest):
+    '''Atomically replace the manifest of a checkpoint directory.'''
+    path = os.path.join(directory, MANIFEST_FILE)
+    with open(path + ".tmp", 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(path + ".tmp", path)
+
+
+def _read_checkpoint(directory, entry):
+    '''Read the weights and the optimizer state of a checkpoint of the manifest.'''
+    with np.load(os.path.join(directory, entry["file"]), allow_pickle=False) as arrays:
+        weights = [arrays[f"weight_{i}"] for i in range(entry["weights"])]
+        optimizer_state = [arrays[f"optimizer_{i}"] for i in range(entry["optimizer"])]
+    return weights, optimizer_state
+
+
+def restore_latest_checkpoint(model, directory):
+    '''Load the latest readable checkpoint of a directory into a compiled model.
+    A checkpoint that cannot be read (interrupted write, deleted file) is skipped for the previous one.
+    Parameters
+    ----------
+    model: tf.keras.Model
+        compiled model, with the architecture and optimizer of the checkpointed one
+    directory: str
+        checkpoint directory of an AsyncCheckpoint callback
+
+    Returns int, number of epochs already done (initial_epoch to pass to fit), 0 if there is no checkpoint
+    '''
+    for entry in reversed(read_checkpoint_manifest(directory)["checkpoints"]):
+        try:
+            weights, optimizer_state = _read_checkpoint(directory, entry)
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+            print(f"Checkpoint {entry['file']} unreadable, trying the previous one.")
+            continue
+        model.set_weights(weights)
+        _restore_optimizer(model, optimizer_state)
+        return entry["epoch"]
+    return 0
+
+
+def _restore_optimizer(model, optimizer_state):
+    '''Assign a saved optimizer state, creating the optimizer slots first (they are created lazily by the first step).'''
+    optimizer = model.optimizer
+    if len(_optimizer_variables(optimizer)) != len(optimizer_state):
+        if hasattr(optimizer, "build"):
+            optimizer.build(model.trainable_variables)
+        else:
+            optimizer._create_all_weights(model.trainable_variables)
+    variables = _optimizer_variables(optimizer)
+    if len(variables) != len(optimizer_state):
+        print(f"Optimizer has {len(variables)} variables but the checkpoint {len(optimizer_state)}, "
+              "optimizer state not restored.")
+        return
+    for variable, value in zip(variables, optimizer_state):
+        variable.assign(value)
+
+
+class AsyncCheckpoint(tf.keras.callbacks.Callback):
+    '''Checkpoint the weights, the optimizer state and the epoch counter from a background thread.
+
+    At the end of an epoch the variables are copied to numpy arrays, then written by a single writer
+    thread while training goes on; a new checkpoint only waits for the previous write to finish. Files
+    are written under a temporary name and renamed once complete, so a preempted run never leaves a
+    truncated checkpoint behind. The last keep_last checkpoints are kept, plus the best one on monitor.
+    Resume with restore_latest_checkpoint.
+    '''
+
+    def __init__(self, directory, every_epochs=1, keep_last=3, monitor="val_loss", mode="min"):
+        '''
+        Parameters
+        ----------
+        directory: str
+            directory of the checkpoints and of their manifest
+        every_epochs: int
+            number of epochs between checkpoints
+        keep_last: int
+            number of most recent checkpoints kept
+        monitor: str
+            logged metric choosing the best checkpoint
+        mode: str
+            "min" if a lower monitor value is better, "max" otherwise
+        '''
+        super().__init__()
+        self.directory = directory
+        self.every_epochs = every_epochs
+        self.keep_last = keep_last
+        self.monitor = monitor
+        self.mode = mode
+        manifest = read_checkpoint_manifest(directory) # a resumed run keeps applying the retention policy
+        self._checkpoints = manifest["checkpoints"]
+        # a best checkpoint chosen on another (or an unrecorded) metric is not comparable
+        self._best = manifest["best"] if manifest["monitor"] == monitor else None
+        self._executor = None
+        self._pending = None
+
+    def on_train_begin(self, logs=None):
+        os.makedirs(self.directory, exist_ok=True)
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def on_epoch_end(self, epoch, logs=None):
+        if (epoch + 1) % self.every_epochs:
+            return
+        value = (logs or {}).get(self.monitor)
+        weights = self.model.get_weights()
+        optimizer_state = [variable.numpy() for variable in _optimizer_variables(self.model.optimizer)]
+        self.wait() # at most one checkpoint held in memory besides the model
+        self._pending = self._executor.submit(self._write, epoch + 1, weights, optimizer_state,
+                                              None if value is None else float(value))
+
+    def on_train_end(self, logs=None):
+        self.wait()
+        self._executor.shutdown()
+
+    def wait(self):
+        '''Block until the checkpoint being written is on disk, raising the error of a failed write.'''
+        if self._pending is not None:
+            pending, self._pending = self._pending, None
+            pending.result()
+
+    def _is_better(self, value):
+        if self._best is None or self._best["value"] is None:
+            return True
+        return value < self._best["value"] if self.mode == "min" else value > self._best["value"]
+
+    def _write(self, epoch, weights, optimizer_state, value):
+        '''Write one checkpoint, then update the manifest and delete the checkpoints no longer kept.'''
+        filename = CHECKPOINT_PATTERN.format(epoch)
+        path = os.path.join(self.directory, filename)
+        arrays = {f"weight_{i}": weight for i, weight in enumerate(weights)}
+        arrays.update({f"optimizer_{i}": state for i, state in enumerate(optimizer_state)})
+        with open(path + ".tmp", 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(path + ".tmp", path)
+
+        entry = {"epoch": epoch, "file": filename, "value": value,
+                 "weights": len(weights), "optimizer": len(optimizer_state)}
+        self._checkpoints = [checkpoint for checkpoint in self._checkpoints if checkpoint["epoch"] < epoch] + [entry]
+        if value is not None and self._is_better(value):
+            self._best = entry
+        kept = {checkpoint["file"] for checkpoint in self._checkpoints[-self.keep_last:]}
+        if self._best is not None:
+            kept.add(self._best["file"])
+        removed = [checkpoint["file"] for checkpoint in self._checkpoints if checkpoint["file"] not in kept]
+        self._checkpoints = [checkpoint for checkpoint in self._checkpoints if checkpoint["file"] in kept]
+        _write_manifest(self.directory, {"checkpoints": self._checkpoints, "best": self._best, "monitor": self.monitor})
+        for filename in removed:
+            if os.path.exists(os.path.join(self.directory, filename)):
+                os.remove(os.path.join(self.directory, filename))
+
+
+class ConvergenceController(tf.keras.callbacks.Callback):
+    '''Stop training once the monitored validation metric stops improving, and restore the best weights.
+
+    Epochs without validation (fit validation_freq > 1) are skipped, so patience counts validation
+    rounds rather than epochs. The best weights are kept in memory and set back on the model when
+    training ends, whether it stopped early or ran all its epochs. A resumed run picks up the best
+    value and the patience already spent from the manifest of its AsyncCheckpoint, which must monitor
+    the same metric.
+    '''
+
+    def __init__(self, monitor="val_mean_io_u", mode="max", patience=5, min_delta=0.0, restore_best_weights=True,
+                 checkpoint_dir=None):
+        '''
+        Parameters
+        ----------
+        monitor: str
+            logged validation metric, "val_mean_io_u" for MeanIoU or "val_loss"
+        mode: str
+            "max" if a higher monitor value is better, "min" otherwise
+        patience: int
+            number of validation rounds without improvement before stopping
+        min_delta: float
+            smallest change of the monitor counted as an improvement
+        restore_best_weights: bool
+            set the weights of the best validation round back at the end of training
+        checkpoint_dir: str
+            checkpoint directory of the AsyncCheckpoint of the run, None not to resume from it
+        '''
+        super().__init__()
+        self.monitor = monitor
+        self.mode = mode
+        self.patience = patience
+        self.min_delta = min_delta
+        self.restore_best_weights = restore_best_weights
+        self.checkpoint_dir = checkpoint_dir
+        self.best = None
+        self.best_epoch = None
+        self.stopped_epoch = None
+        self._best_weights = None
+        self._best_checkpoint = None
+        self._wait = 0
+
+    def on_train_begin(self, logs=None):
+        self.best, self.best_epoch, self.stopped_epoch = None, None, None
+        self._best_weights = None
+        self._best_checkpoint = None
+        self._wait = 0
+        if self.checkpoint_dir is None:
+            return
+        manifest = read_checkpoint_manifest(self.checkpoint_dir)
+        best = manifest["best"]
+        if manifest["monitor"] != self.monitor or best is None or best["value"] is None:
+            return
+        self.best, self.best_epoch = best["value"], best["epoch"]
+        self._best_checkpoint = best
+        # validations checkpointed since the best one did not improve on it (lower bound when keep_last < patience)
+        self._wait = sum(1 for checkpoint in manifest["checkpoints"]
+                         if checkpoint["epoch"] > best["epoch"] and checkpoint["value"] is not None)
+        print(f"Resuming with best {self.monitor} = {self.best:.4f} at epoch {self.best_epoch}, "
+              f"{self._wait} validations without improvement.")
+
+    def _improved(self, value):
+        if self.best is None:
+            return True
+        return value < self.best - self.min_delta if self.mode == "min" else value > self.best + self.min_delta
+
+    def on_epoch_end(self, epoch, logs=None):
+        value = (logs or {}).get(self.monitor)
+        if value is None:
+            return
+        if self._improved(float(value)):
+            self.best, self.best_epoch = float(value), epoch + 1
+            self._wait = 0
+            self._best_checkpoint = None
+            if self.restore_best_weights:
+                self._best_weights = self.model.get_weights()
+            return
+        self._wait += 1
+        if self._wait >= self.patience:
+            self.stopped_epoch = epoch + 1
+            self.model.stop_training = True
+            print(f"No {self.monitor} improvement for {self.patience} validations, stopping after epoch {epoch + 1}.")
+
+    def on_train_end(self, logs=None):
+        if self.restore_best_weights and self._best_checkpoint is not None: # best epoch from before the resume
+            try:
+                self._best_weights, _ = _read_checkpoint(self.checkpoint_dir, self._best_checkpoint)
+            except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+                print(f"Best checkpoint {self._best_checkpoint['file']} unreadable, last weights kept.")
+        if self._best_weights is not None:
+            self.model.set_weights(self._best_weights)
+            print(f"Best weights restored ({self.monitor} = {self.best:.4f} at epoch {self.best_epoch}).")
+
+
+def peak_rss_bytes():
+    '''Return the peak resident memory of the process in bytes, None where it cannot be measured.'''
+    try:
+        import resource
+    except ImportError: # Windows
+        try:
+            import psutil
+        except ImportError:
+            return None
+        return getattr(psutil.Process().memory_info(), "peak_wset", None)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024 # kilobytes on Linux
+
+
+class TrainingTelemetry(tf.keras.callbacks.Callback):
+    '''Record the throughput of every epoch and where its time went, in JSONL and CSV files.
+
+    The train step of the model is wrapped to timestamp the moment its batch is ready, which splits
+    each step into the time spent waiting on the input pipeline and the time spent computing. Every
+    epoch adds a record with the images per second, the step times, the input wait and compute times,
+    the validation time, the peak resident memory, the epoch logs and the hyperparameters of the run.
+    '''
+
+    def __init__(self, path_prefix, hyperparameters=None):
+        '''
+        Parameters
+        ----------
+        path_prefix: str
+            records are appended to path_prefix + ".jsonl" and path_prefix + ".csv"
+        hyperparameters: dict
+            hyperparameters of the run, repeated in every record (as "hp_" columns in the CSV file)
+        '''
+        super().__init__()
+        self.path_prefix = path_prefix
+        self.hyperparameters = dict(hyperparameters or {})
+        self.records = []
+        self._batch_ready = tf.Variable(0.0, dtype=tf.float64, trainable=False)
+        self._batch_images = tf.Variable(0, dtype=tf.int64, trainable=False)
+        self._wrapped_models = set()
+
+    def set_model(self, model):
+        super().set_model(model)
+        if id(model) in self._wrapped_models:
+            return
+        # called by fit before the train function is traced, so the wrapped step is the one compiled
+        train_step = model.train_step
+
+        def timed_train_step(data):
+            self._batch_ready.assign(tf.timestamp())
+            self._batch_images.assign(tf.cast(tf.shape(tf.nest.flatten(data)[0])[0], tf.int64))
+            return train_step(data)
+
+        model.train_step = timed_train_step
+        self._wrapped_models.add(id(model))
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._epoch_start = time.time()
+        self._step_times, self._input_waits = [], []
+        self._images = 0
+        self._validation_seconds = 0.0
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self._step_start = time.time()
+
+    def on_train_batch_end(self, batch, logs=None):
+        end = time.time()
+        batch_ready = float(self._batch_ready.numpy())
+        self._step_times.append(end - self._step_start)
+        self._input_waits.append(min(max(batch_ready - self._step_start, 0.0), end - self._step_start))
+        self._images += int(self._batch_images.numpy())
+
+    def on_test_begin(self, logs=None):
+        self._validation_start = time.time()
+
+    def on_test_end(self, logs=None):
+        self._validation_seconds += time.time() - self._validation_start
+
+    def on_epoch_end(self, epoch, logs=None):
+        seconds = time.time() - self._epoch_start
+        step_times = np.array(self._step_times) * 1000
+        train_seconds = float(np.sum(self._step_times))
+        input_wait = float(np.sum(self._input_waits))
+        record = {
+            "epoch": epoch + 1,
+            "seconds": seconds,
+            "images": self._images,
+            "images_per_second": self._images / train_seconds if train_seconds > 0 else 0.0,
+            "steps": len(step_times),
+            "step_ms_mean": float(step_times.mean()) if len(step_times) else float("nan"),
+            "step_ms_p50": float(np.percentile(step_times, 50)) if len(step_times) else float("nan"),
+            "step_ms_p95": float(np.percentile(step_times, 95)) if len(step_times) else float("nan"),
+            "input_wait_seconds": input_wait,
+            "compute_seconds": train_seconds - input_wait,
+            "input_wait_fraction": input_wait / train_seconds if train_seconds > 0 else 0.0,
+            "validation_seconds": self._validation_seconds,
+            "peak_rss_bytes": peak_rss_bytes(),
+        }
+        # every record has the training and validation metrics, None when validation did not run this epoch
+        logs = logs or {}
+        for name in self.model.metrics_names:
+            for key in (name, "val_" + name):
+                record[key] = float(logs[key]) if key in logs else None
+        self.records.append(record)
+        self._write(record)
+
+    def _write(self, record):
+        '''Append a record to the JSONL file and to the CSV file, writing the CSV header with the first record.'''
+        with open(self.path_prefix + ".jsonl", 'a', encoding='utf-8') as f:
+            f.write(json.dumps(dict(record, hyperparameters=self.hyperparameters)) + "\n")
+
+        row = dict(record, **{"hp_" + name: value for name, value in self.hyperparameters.items()})
+        csv_path = self.path_prefix + ".csv"
+        fieldnames = None
+        if os.path.exists(csv_path): # a resumed run keeps the columns of the file
+            with open(csv_path, 'r', encoding='utf-8', newline='') as f:
+                fieldnames = next(csv.reader(f), None)
+        with open(csv_path, 'a', encoding='utf-8', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames or list(row), extrasaction='ignore')
+            if not fieldnames:
+                writer.writeheader()
+            writer.writerow(row)
@@ -17,11 +17,15 @@ import tensorflow as tf
 import numpy as np
 import matplotlib.pyplot as plt
 from os import listdir, makedirs
-from os.path import isfile, join, isdir
+from os.path import isfile, join, isdir, basename
 import cProfile, pstats
+from concurrent.futures import ThreadPoolExecutor
 import sys
-from skimage import transform, color
 from image_processing import *
+from dataset_store import ArrayDatasetStore, load_image_directory_cached
+from augmentation import affine_coordinates, augment_batch, augmented_copies, warp_batch
+from feature_cache import cached_feature_datasets
+from training_callbacks import AsyncCheckpoint, ConvergenceController, TrainingTelemetry, restore_latest_checkpoint
 import json
 
 
@@ -43,11 +47,21 @@ def open_pkl_matrix(directory):
     return dataset
     #return tuple(dataset)
     
+def open_dataset_store(directory):
+    '''Load a dataset saved as an ArrayDatasetStore (see dataset_store.convert_pickle_directory).'''
+    store = ArrayDatasetStore(directory)
+    return np.reshape(store.to_array(), (len(store), 160, 160, 1))
+    
+def load_image_dataset(directory, cache_dir="oral_dataset/decoded_cache", workers=None):
+    '''Load a directory of images as a (N, 160, 160, 1) uint8 array, in sorted filename order.
+    Images are decoded by a process pool once, then read from a memory-mapped cache under cache_dir
+    that only re-decodes new or modified files (see dataset_store.load_image_directory_cached).'''
+    store = load_image_directory_cached(directory, cache_dir, (160, 160), workers)
+    return np.reshape(store.to_array(), (len(store), 160, 160, 1))
+    
 def create_dataset_from_images(directory):
     dataset = []
-    all_filenames = [f for f in listdir(directory) if isfile(join(directory, f))]
-    for filename in all_filenames:
-        path = directory + "/" + filename
+    for path in list_dataset_files(directory): # sorted, so that images and masks pair up
         img_array = np.array(Image.open(path).convert("L"))
         data = np.reshape(img_array, (160, 160, 1))
         dataset.append(data)
@@ -64,48 +78,247 @@ def flipping(x, y):
 
     
 def random_rotation(x, y):
-
+    '''Rotate an image and its mask by the same random angle of at most +- 7 degrees.'''
     angle = np.random.randint(8) # rotation of +- 8° maximum
     sens = np.random.randint(2)
     if sens == 0: # randomly introduce counter-clockwise rotation
         angle *= -1
-   
-    x_rotated = transform.rotate(x, angle)
-    y_rotated = transform.rotate(y, angle)
-    
-    x_rotated = transform.resize(x_rotated, (160, 160))
-    y_rotated = transform.resize(y_rotated, (160, 160))
-    
-    x_rotated = color.rgb2gray(x_rotated)
-    y_rotated = color.rgb2gray(y_rotated)
-    
+
+    parameters = {"angle": np.array([angle]), "scale": np.ones(1), "shift_y": np.zeros(1), "shift_x": np.zeros(1)}
+    coordinates = affine_coordinates(parameters, 160, 160)
+    x_rotated = warp_batch(np.reshape(x, (1, 160, 160)), coordinates, order=1)
+    y_rotated = warp_batch(np.reshape(y, (1, 160, 160)), coordinates, order=1)
+
     #x_rotated = x_rotated*255 use only if starting from photos
     # do not multiply y by 255 because we want it to stay between 0 and 1
 
     return (np.reshape(x_rotated, (160, 160, 1)), np.reshape(y_rotated, (160, 160, 1)))
     
     
+# Deprecated: training_session augments batches on the fly with make_batch_augmentation, or ahead of
+# training with augmentation.augmented_copies; kept for the scripts still calling it
 def create_data_augmentation(x_training_dataset, y_training_dataset):
-    new_x_dataset = []
-    new_y_dataset = []
-    for x, y in zip(x_training_dataset, y_training_dataset):
-        
-        new_x_dataset.append(x)
-        new_y_dataset.append(y)
+    '''Return the dataset followed by a randomly rotated copy and a flipped copy of every sample.'''
+    x = np.reshape(x_training_dataset, (-1, 160, 160, 1)).astype(np.float32, copy=False)
+    y = np.reshape(y_training_dataset, (-1, 160, 160, 1)).astype(np.float32, copy=False)
+    x_rotated, y_rotated = augment_batch(x, y, max_angle=8, mask_order=1)
+    x_flipped, y_flipped = x[:, :, ::-1], y[:, :, ::-1]
+
+    # keep the original, rotated, flipped order of each sample
+    new_x_dataset = np.stack([x, x_rotated, x_flipped], axis=1).reshape(-1, 160, 160, 1)
+    new_y_dataset = np.stack([y, y_rotated, y_flipped], axis=1).reshape(-1, 160, 160, 1)
+    return (new_x_dataset, new_y_dataset)
+
+def list_dataset_files(directory):
+    '''List the files of a dataset directory, sorted so that images and masks pair up by position.'''
+    return sorted(join(directory, f) for f in listdir(directory) if isfile(join(directory, f)))
+
+
+def _decode_sample(path):
+    '''Read an image file into a (160, 160, 1) uint8 tensor.'''
+    img = tf.io.decode_image(tf.io.read_file(path), channels=1, expand_animations=False)
+    return tf.reshape(img, (160, 160, 1))
+
+
+def _rotation_transforms(angles, height, width):
+    '''Projective transforms rotating images of a batch counter-clockwise about their center (angles in radians).'''
+    cos_angles = tf.cos(angles)
+    sin_angles = tf.sin(angles)
+    x_offset = ((width - 1) - (cos_angles * (width - 1) - sin_angles * (height - 1))) / 2.0
+    y_offset = ((height - 1) - (sin_angles * (width - 1) + cos_angles * (height - 1))) / 2.0
+    zeros = tf.zeros_like(angles)
+    return tf.stack([cos_angles, -sin_angles, x_offset, sin_angles, cos_angles, y_offset, zeros, zeros], axis=1)
+
+
+def _transform_batch(images, transforms, interpolation):
+    '''Warp a batch of images with one transform per image, filling the outside with black.'''
+    return tf.raw_ops.ImageProjectiveTransformV3(images=images, transforms=transforms, output_shape=tf.shape(images)[1:3],
+                                                 fill_value=0.0, interpolation=interpolation, fill_mode="CONSTANT")
+
+
+def make_batch_augmentation(flip_probability=0.5, rotation_probability=0.5, max_angle=8, seed=None):
+    '''Create a function adding the augmentation of whole (x, y) batches to an input pipeline.
+    Each sample is flipped left-right and rotated by a random angle with the given probabilities, 
+    with new draws every time a batch goes through, so every epoch sees fresh augmentations.
+    The seeds of the batches are drawn from the generator by a sequential map, in batch order, and the
+    batches are augmented by a parallel map with stateless random ops only: with a seed, the augmentation
+    of every batch is reproducible whatever the scheduling of the parallel calls.
+    Parameters
+    ----------
+    flip_probability: float
+        probability of flipping a sample
+    rotation_probability: float
+        probability of rotating a sample
+    max_angle: float
+        largest rotation in degrees, in either direction
+    seed: int
+        seed making the sequence of augmentations reproducible
         
-        x = np.reshape(x, (160, 160))
-        y = np.reshape(y, (160, 160))   
+    Returns function mapping a tf.data.Dataset of (x, y) batches of shape (N, 160, 160, 1) to the dataset
+    of the augmented batches
+    '''
+    rng = tf.random.Generator.from_seed(seed) if seed is not None else tf.random.Generator.from_non_deterministic_state()
+    max_radians = max_angle * PI / 180
+
+    def augment(x, y, seeds):
+        batch_size = tf.shape(x)[0]
+        flipped = tf.random.stateless_uniform([batch_size], seeds[:, 0]) < flip_probability
+        x = tf.where(flipped[:, None, None, None], tf.reverse(x, axis=[2]), x)
+        y = tf.where(flipped[:, None, None, None], tf.reverse(y, axis=[2]), y)
+
+        rotated = tf.random.stateless_uniform([batch_size], seeds[:, 1]) < rotation_probability
+        angles = tf.random.stateless_uniform([batch_size], seeds[:, 2], -max_radians, max_radians)
+        angles = tf.where(rotated, angles, tf.zeros_like(angles))
+        transforms = _rotation_transforms(angles, tf.cast(tf.shape(x)[1], tf.float32), tf.cast(tf.shape(x)[2], tf.float32))
+        x = _transform_batch(x, transforms, "BILINEAR")
+        y = _transform_batch(y, transforms, "NEAREST") # keep mask values at 0 or 1
+        return (x, y)
+
+    def add_augmentation(dataset):
+        dataset = dataset.map(lambda x, y: (x, y, rng.make_seeds(3))) # sequential: one generator draw per batch, in order
+        return dataset.map(augment, num_parallel_calls=tf.data.AUTOTUNE)
+
+    return add_augmentation
+
+
+def random_subset(n_total, n_samples=None, seed=0):
+    '''Draw a fixed random subset of n_samples sample indices, in increasing order, all of them when n_samples is None.'''
+    if n_samples is None or n_samples >= n_total:
+        return np.arange(n_total)
+    return np.sort(np.random.default_rng(seed).choice(n_total, n_samples, replace=False))
+
+
+def _memmap_reader(arrays):
+    '''Create a tf.data map function reading the samples at an index, or a batch of indices, from memory-mapped arrays.'''
+    def read_numpy(index):
+        if index.ndim:
+            index = np.sort(index) # memory maps read faster in order
+        return [np.asarray(array[index]) for array in arrays]
+
+    def read(index):
+        samples = tf.numpy_function(read_numpy, [index], [tf.as_dtype(array.dtype) for array in arrays], stateful=False)
+        samples = [tf.ensure_shape(sample, index.shape.concatenate(array.shape[1:])) for sample, array in zip(samples, arrays)]
+        return samples[0] if len(samples) == 1 else tuple(samples)
+
+    return read
+
+
+def create_tf_dataset(x_directory, y_directory=None, batch_size=None, shuffle=False, shuffle_buffer=1024, 
+                      cache=None, batch_augment=None, decoded_cache_dir=None, dtype="float32", n_samples=None, subset_seed=0):
+    '''Build a streaming tf.data pipeline over a directory of images and, optionally, their masks.
+    Files are decoded and reshaped in parallel. Samples stay uint8 in the cache and the shuffle buffer,
+    and are only converted to dtype once batched, masks being divided by 255 to get 0 or 1 values.
+    Parameters
+    ----------
+    x_directory: str
+        directory of ultrasound images
+    y_directory: str
+        directory of masks, paired with the images in sorted filename order
+    batch_size: int
+        size of the batches, None to yield samples one by one
+    shuffle: bool
+        shuffle the samples every epoch within a buffer of shuffle_buffer samples, or all of them with decoded_cache_dir
+    cache: str
+        None not to cache decoded samples, "" to cache them in memory, or the path of a cache file. 
+        Ignored with decoded_cache_dir, whose memory maps already hold the decoded samples
+    batch_augment: function
+        function adding the augmentation of (x, y) batches to a dataset (see make_batch_augmentation), applied after batching
+    decoded_cache_dir: str
+        directory of the decoded image caches (see load_image_dataset), None to decode the files in the pipeline
+    dtype: str
+        dtype of the batches fed to the model, "float32" or "float16"
+    n_samples: int
+        number of samples of a random subset drawn once with subset_seed, None for all the samples. The subset is
+        taken before the cache, which then holds all of it
+    subset_seed: int
+        seed of the subset, the same subset being drawn at every run
         
-        rotated = random_rotation(x, y)
-        new_x_dataset.append(rotated[0])
-        new_y_dataset.append(rotated[1])
+    Returns tf.data.Dataset of x, or of (x, y) pairs
+    '''
+    x_paths = list_dataset_files(x_directory)
+    if y_directory is not None:
+        y_paths = list_dataset_files(y_directory)
+        if len(x_paths) != len(y_paths):
+            raise ValueError(f"{x_directory} has {len(x_paths)} images but {y_directory} has {len(y_paths)} masks")
+    subset = random_subset(len(x_paths), n_samples, subset_seed)
+
+    if decoded_cache_dir is not None:
+        # the samples are read by index from the memory maps, batch by batch, instead of being copied
+        # into a tensor and then into a second cache
+        arrays = [load_image_dataset(x_directory, decoded_cache_dir)]
+        if y_directory is not None:
+            arrays.append(load_image_dataset(y_directory, decoded_cache_dir))
+        dataset = tf.data.Dataset.from_tensor_slices(subset)
+        if shuffle:
+            dataset = dataset.shuffle(len(subset), reshuffle_each_iteration=True) # indices are small enough to shuffle all at once
+        if batch_size is not None:
+            dataset = dataset.batch(batch_size)
+        dataset = dataset.map(_memmap_reader(arrays), num_parallel_calls=tf.data.AUTOTUNE)
+    else:
+        x_paths = [x_paths[i] for i in subset]
+        if y_directory is None:
+            dataset = tf.data.Dataset.from_tensor_slices(x_paths)
+            dataset = dataset.map(_decode_sample, num_parallel_calls=tf.data.AUTOTUNE)
+        else:
+            dataset = tf.data.Dataset.from_tensor_slices((x_paths, [y_paths[i] for i in subset]))
+            dataset = dataset.map(lambda x_path, y_path: (_decode_sample(x_path), _decode_sample(y_path)),
+                                  num_parallel_calls=tf.data.AUTOTUNE)
+        if cache is not None:
+            dataset = dataset.cache(cache)
+        if shuffle:
+            dataset = dataset.shuffle(shuffle_buffer, reshuffle_each_iteration=True)
+        if batch_size is not None:
+            dataset = dataset.batch(batch_size)
+    if y_directory is None:
+        dataset = dataset.map(lambda x: tf.cast(x, dtype), num_parallel_calls=tf.data.AUTOTUNE)
+    else:
+        dataset = dataset.map(lambda x, y: (tf.cast(x, dtype), tf.cast(y, dtype) / 255), # need 0 or 1
+                              num_parallel_calls=tf.data.AUTOTUNE)
+    if batch_augment is not None:
+        dataset = batch_augment(dataset)
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+def _is_memory_mapped(array):
+    '''Tell whether an array, or the array it is a view of, is a memory map.'''
+    while isinstance(array, np.ndarray):
+        if isinstance(array, np.memmap):
+            return True
+        array = array.base
+    return False
+
+
+def dataset_memory_report(splits):
+    '''Count the bytes of samples each dataset split holds in RAM.
+    Memory-mapped arrays are not counted: their pages belong to the OS file cache, which evicts them when needed.
+    Parameters
+    ----------
+    splits: dict
+        split name -> list of arrays, or of directories whose decoded samples create_tf_dataset caches in memory 
+        (160x160 uint8 samples, see _decode_sample), or of (directory, n_samples) pairs when only a subset is cached. 
+        File caches and streamed directories are left out by the caller
         
-        flipped = flipping(x, y)
-        new_x_dataset.append(np.reshape(flipped[0], (160, 160, 1)))
-        new_y_dataset.append(np.reshape(flipped[1], (160, 160, 1)))
+    Returns dict of bytes per split, with a "total" entry
+    '''
+    def held_bytes(source):
+        if isinstance(source, np.ndarray):
+            return 0 if _is_memory_mapped(source) else int(source.nbytes)
+        directory, n_samples = source if isinstance(source, tuple) else (source, None)
+        return len(random_subset(len(list_dataset_files(directory)), n_samples)) * 160 * 160
+
+    report = {}
+    for name, sources in splits.items():
+        report[name] = sum(held_bytes(source) for source in sources)
+    report["total"] = sum(report.values())
+    return report
+
 
+def write_masks(masks, paths, workers=4):
+    '''Save a batch of (N, 160, 160) masks as images, one path per mask, with a pool of threads encoding them.'''
+    with ThreadPoolExecutor(workers) as pool:
+        for future in [pool.submit(save_img_from_array, mask, path) for mask, path in zip(masks, paths)]:
+            future.result()
 
-    return (np.array(new_x_dataset), np.array(new_y_dataset))
 
 def show_augmentated_img():
     with open("OASBUDdata/x_training_dataset/subj66_rf1.pkl", "rb") as pkl_file:
@@ -159,8 +372,13 @@ def init_model():
     print("Decoder unfrozen.")
     return loaded_model
     
-def training_session(segmentation_results_path, saved_weights_path, EPOCHS=1, INIT_LRATE=0.001, DECAY_STEPS=1e5, BATCH_SIZE=64):
+def training_session(segmentation_results_path, saved_weights_path, EPOCHS=1, INIT_LRATE=0.001, DECAY_STEPS=1e5, BATCH_SIZE=64, 
+                     CACHE_DIR=None, FLIP_PROBABILITY=0.5, ROTATION_PROBABILITY=0.5, AUGMENTATION_SEED=None, 
+                     DECODED_CACHE_DIR="oral_dataset/decoded_cache", FEATURE_CACHE_DIR=None, AUGMENTED_COPIES=0, 
+                     INPUT_DTYPE="float32", CHECKPOINT_DIR=None, CHECKPOINT_EVERY=1, KEEP_CHECKPOINTS=3, 
+                     PATIENCE=None, MONITOR="val_mean_io_u", VALIDATION_FREQ=1, VALIDATION_STEPS=None):
     # Hyperparameters
+    hyperparameters = dict(locals()) # recorded with the telemetry of the run
     print(EPOCHS, INIT_LRATE, DECAY_STEPS, BATCH_SIZE)
     DECAY_RATE = INIT_LRATE / EPOCHS 
     # GET MODEL
@@ -173,24 +391,56 @@ def training_session(segmentation_results_path, saved_weights_path, EPOCHS=1, IN
     #x_validation = open_pkl_matrix("whole_dataset/validation_dataset/x/pkl")
     #y_validation = open_pkl_matrix("whole_dataset/validation_dataset/y/pkl")/255 # need 0 or 1
     #testing_dataset = open_pkl_matrix("whole_dataset/testing_dataset/x/pkl")    
+    # same datasets converted to array stores: open_dataset_store("whole_dataset/training_dataset/x/store")
     
-    # GET TRAINING, VALIDATION AND TESTING DATA from images create_dataset_from_images
-    x_training_dataset = create_dataset_from_images("oral_dataset/training/us")
-    print("Training US OK")
-    y_training_dataset = create_dataset_from_images("oral_dataset/training/mask")/255
-    print("Training mask OK")
-    x_validation = create_dataset_from_images("oral_dataset/validation/us")
-    print("Validation US OK")
-    y_validation = create_dataset_from_images("oral_dataset/validation/mask")/255
-    print("Validation mask OK")
-    testing_dataset = create_dataset_from_images("oral_dataset/testing/us")
-    print("Testing US OK")
-    
-    augmentated_datasets = create_data_augmentation(x_training_dataset, y_training_dataset)  # DATA AUGMENTATION
-    print("Data augmentation OK")
+    # GET TRAINING, VALIDATION AND TESTING DATA from images, streamed with tf.data
+    # images are decoded once into memory-mapped caches under DECODED_CACHE_DIR (None to decode them at every run)
+    # decoded samples are cached in memory, or in files under CACHE_DIR, as uint8: batches are only
+    # converted to INPUT_DTYPE ("float32" or "float16") in the pipeline
+    cache = lambda name: "" if CACHE_DIR is None else join(CACHE_DIR, name)
+    if CACHE_DIR is not None and isdir(CACHE_DIR) == False:
+        makedirs(CACHE_DIR)
+    trained_model = loaded_model
+    # validation on a random subset of VALIDATION_STEPS batches, the same at every run and fully cached
+    n_validation = None if VALIDATION_STEPS is None else VALIDATION_STEPS * BATCH_SIZE
+    if FEATURE_CACHE_DIR is None:
+        training_dataset = create_tf_dataset("oral_dataset/training/us", "oral_dataset/training/mask", BATCH_SIZE, shuffle=True,
+                                             cache=cache("training"), # DATA AUGMENTATION, drawn again for every batch
+                                             batch_augment=make_batch_augmentation(FLIP_PROBABILITY, ROTATION_PROBABILITY, seed=AUGMENTATION_SEED),
+                                             decoded_cache_dir=DECODED_CACHE_DIR, dtype=INPUT_DTYPE)
+        validation_dataset = create_tf_dataset("oral_dataset/validation/us", "oral_dataset/validation/mask", BATCH_SIZE, 
+                                               cache=cache("validation"), decoded_cache_dir=DECODED_CACHE_DIR, dtype=INPUT_DTYPE,
+                                               n_samples=n_validation)
+        # only the in-memory cache holds samples, decoded caches are memory-mapped and CACHE_DIR is on disk
+        in_memory = CACHE_DIR is None and DECODED_CACHE_DIR is None
+        splits = {"training": ["oral_dataset/training/us", "oral_dataset/training/mask"] if in_memory else [], 
+                  "validation": [("oral_dataset/validation/us", n_validation), ("oral_dataset/validation/mask", n_validation)] if in_memory else []}
+    else:
+        # DECODER-ONLY FINE-TUNING: the frozen encoder runs once over the data, its activations are cached
+        # under FEATURE_CACHE_DIR and only the decoder runs during training (it shares its layers with loaded_model)
+        # DATA AUGMENTATION can't be drawn per batch any more: AUGMENTED_COPIES augmented copies of the training set
+        load = lambda directory: load_image_dataset(directory, DECODED_CACHE_DIR) if DECODED_CACHE_DIR else create_dataset_from_images(directory)
+        x_training, y_training = load("oral_dataset/training/us"), load("oral_dataset/training/mask")
+        if AUGMENTED_COPIES > 0:
+            x_training, y_training = augmented_copies(x_training, y_training, AUGMENTED_COPIES, FLIP_PROBABILITY, ROTATION_PROBABILITY,
+                                                      seed=AUGMENTATION_SEED, max_angle=8)
+        x_validation, y_validation = load("oral_dataset/validation/us"), load("oral_dataset/validation/mask")
+        if n_validation is not None:
+            subset = random_subset(len(x_validation), n_validation)
+            x_validation, y_validation = x_validation[subset], y_validation[subset]
+        trained_model, training_dataset, validation_dataset = cached_feature_datasets(
+            loaded_model, x_training, y_training, x_validation, y_validation, FEATURE_CACHE_DIR, BATCH_SIZE, 
+            seed=AUGMENTATION_SEED, dtype=np.dtype(INPUT_DTYPE))
+        splits = {"training": [x_training, y_training], "validation": [x_validation, y_validation]}
+    testing_dataset = create_tf_dataset("oral_dataset/testing/us", batch_size=BATCH_SIZE, decoded_cache_dir=DECODED_CACHE_DIR, 
+                                        dtype=INPUT_DTYPE)
+    splits["testing"] = [] # streamed, never held
 
-    testing_filenames = [f for f in listdir("oral_dataset/testing/us") if isfile(join("oral_dataset/testing/us", f))]    
-    print("Datasets loaded.")
+    testing_filenames = [basename(path) for path in list_dataset_files("oral_dataset/testing/us")]    
+    print("Datasets ready.")
+    memory_report = dataset_memory_report(splits)
+    for split, nbytes in memory_report.items():
+        print(f"{split} samples: {nbytes/1e6:.1f} MB")
     
     # TRAINING THE MODEL
     print("Beginning the training.")
@@ -198,10 +448,31 @@ def training_session(segmentation_results_path, saved_weights_path, EPOCHS=1, IN
 
     # MAIN IMPLEMENTATION
     lr_schedule = tf.keras.optimizers.schedules.ExponentialDecay(INIT_LRATE, decay_steps=DECAY_STEPS, decay_rate=DECAY_RATE, staircase=True)
-    loaded_model.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=lr_schedule),
+    trained_model.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=lr_schedule),
               loss=tf.keras.losses.BinaryCrossentropy(from_logits=True),
               metrics=[tf.keras.metrics.MeanIoU(num_classes=2)]) 
-    historique = loaded_model.fit(augmentated_datasets[0], augmentated_datasets[1], epochs=EPOCHS, validation_data=(x_validation, y_validation), batch_size=BATCH_SIZE)
+    
+    # TELEMETRY of every epoch (throughput, step time, input wait, peak memory) in telemetry.jsonl and telemetry.csv
+    callbacks = [TrainingTelemetry(segmentation_results_path + "telemetry", hyperparameters)]
+    # CHECKPOINTS written in the background every CHECKPOINT_EVERY epochs, an interrupted run resumes from the latest one
+    initial_epoch = 0
+    if CHECKPOINT_DIR is not None:
+        initial_epoch = restore_latest_checkpoint(trained_model, CHECKPOINT_DIR)
+        if initial_epoch > 0:
+            print(f"Resuming the training after epoch {initial_epoch}.")
+    # the best checkpoint and early stopping both follow MONITOR
+    mode = "min" if MONITOR.endswith("loss") else "max"
+    if CHECKPOINT_DIR is not None:
+        callbacks.append(AsyncCheckpoint(CHECKPOINT_DIR, CHECKPOINT_EVERY, KEEP_CHECKPOINTS, MONITOR, mode))
+    # EARLY STOPPING after PATIENCE validations without MONITOR improvement, keeping the best weights
+    # a resumed run starts from the best value and the patience recorded in CHECKPOINT_DIR
+    # validation runs every VALIDATION_FREQ epochs, on a fixed random subset of VALIDATION_STEPS batches (None for all of them)
+    convergence = None
+    if PATIENCE is not None:
+        convergence = ConvergenceController(MONITOR, mode, PATIENCE, checkpoint_dir=CHECKPOINT_DIR)
+        callbacks.append(convergence)
+    historique = trained_model.fit(training_dataset, epochs=EPOCHS, validation_data=validation_dataset, 
+                                   validation_freq=VALIDATION_FREQ, initial_epoch=initial_epoch, callbacks=callbacks)
     print("Training done.")     
     
     # SAVE THE NEW MODEL
@@ -211,6 +482,10 @@ def training_session(segmentation_results_path, saved_weights_path, EPOCHS=1, IN
     # récupérer metrics
   
     data = historique.history
+    data['memory_bytes'] = memory_report
+    if convergence is not None:
+        data['best_epoch'] = convergence.best_epoch
+        data['stopped_epoch'] = convergence.stopped_epoch
     data['historique'] = str(EPOCHS)+str("/")+str(INIT_LRATE)+str("/")+str(DECAY_STEPS)+str("/")+str(BATCH_SIZE)
     
 
@@ -222,26 +497,10 @@ def training_session(segmentation_results_path, saved_weights_path, EPOCHS=1, IN
 
     
     # TESTING THE MODEL
-    file_nbr = 0
-    for data in testing_dataset:
-        predictions = loaded_model.predict(np.reshape(data, (1, 160, 160))) # Make prediction
-        predictions = np.reshape(predictions, (160, 160)) # Restore predictions array to correct format
-
-        # Replace prediction with pixel value it approximates 
-        classified_predictions = np.ones((160, 160))
-        for i in range(160):
-            for j in range(160):
-                if predictions[(i, j)] < 0.5:
-                    classified_predictions[(i, j)] = 0 # black
-                else: 
-                    classified_predictions[(i, j)] = 255 # white
-
-        seg_img = Image.fromarray(classified_predictions) # Convert numpy array to image
-        seg_img = seg_img.convert('L') # Convert image to black and white
-        #seg_img.show() # Afficher l'image
-        filename = segmentation_results_path + testing_filenames[file_nbr] + ".jpg"
-        seg_img.save(filename)
-        file_nbr += 1
+    # one batched prediction over the whole testing set, thresholded at once, masks written as PNG in parallel
+    predictions = loaded_model.predict(testing_dataset)
+    classified_predictions = create_img_from_predictions(np.reshape(predictions, (-1, 160, 160)))
+    write_masks(classified_predictions, [segmentation_results_path + filename + ".png" for filename in testing_filenames])
         
         
 
@@ -252,7 +511,8 @@ def main():
     if isdir(segmentation_results_path) == False:
         makedirs(segmentation_results_path)
     saved_weights_path = "oral_dataset/testing/segmentation1/OASBUD_unet_b_IOU.h5"
-    training_session(segmentation_results_path, saved_weights_path, 50, 0.0005, 1e5, 2)
+    training_session(segmentation_results_path, saved_weights_path, 50, 0.0005, 1e5, 2, 
+                     CHECKPOINT_DIR=segmentation_results_path + "checkpoints", PATIENCE=5)
         
 if __name__ == '__main__':
     profiler = cProfile.Profile()